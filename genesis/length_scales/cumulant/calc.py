@@ -9,20 +9,16 @@ import numpy as np
 from scipy.constants import pi
 import scipy.optimize
 import scipy.integrate
+import scipy.ndimage
 from ...utils.intergrid import intergrid
 import xarray as xr
 from tqdm import tqdm
 from enum import Enum
 import skimage.measure
 
-try:
-    import pyfftw.interfaces
-    fft = pyfftw.interfaces.numpy_fft
-    pyfftw.interfaces.cache.enable()
-    print("Using pyfftw")
-except ImportError:
-    import numpy.fft as fft
-    print("Using numpy.fft fallback")
+# the FFT backend (pyfftw, scipy.fft or numpy.fft) and number of threads can be
+# set with `fft_backend.configure(...)` or through environment variables
+from . import fft_backend as fft
 
 _var_name_mapping = {
     "q": r"q_t",
@@ -81,77 +77,198 @@ def fix_cumulant_name(name):
     else:
         return r"$C({},{})$".format(v1_latex, v2_latex)
 
-def calc_2nd_cumulant(v1, v2=None, mask=None):
+def _cumulant_attrs(v1, v2, mask=None):
+    """
+    Build name and attributes for the cumulant of `v1` and `v2`
+    """
+    # let's give it a useful name and description
+    long_name = r"$C({},{})$".format(
+        _var_name_mapping.get(v1.name, v1.long_name),
+        _var_name_mapping.get(v2.name, v2.long_name),
+    )
+    v1_name = v1.name if v1.name is not None else v1.long_name
+    v2_name = v2.name if v2.name is not None else v2.long_name
+    name = "C({},{})".format(v1_name, v2_name)
+
+    if mask is not None:
+        long_name = "{} masked by {}".format(long_name, mask.long_name)
+
+    attrs = dict(units="{} {}".format(v1.units, v2.units), long_name=long_name)
+
+    return name, attrs
+
+def _horizontal_axes(da):
+    """
+    Indices of the horizontal (x, y) axes of `da`, any other dimensions
+    (e.g. `zt`) are treated as a batch dimension
+    """
+    if not 'x' in da.dims or not 'y' in da.dims:
+        raise NotImplementedError(da.dims)
+    return (da.dims.index('x'), da.dims.index('y'))
+
+def _horizontal_spectrum(v, mask=None, single_precision=False):
+    """
+    Real-to-complex Fourier transform in the horizontal of the horizontal
+    perturbation of `v`. Regions outside `mask` are set to zero (i.e. to the
+    mean). With `single_precision` the transform is done in float32/complex64
+    """
+    old_attrs = v.attrs
+    if single_precision:
+        v = v.astype(np.float32)
+    v = v - v.mean(dim=('x', 'y'))
+    v.attrs = old_attrs
+
+    if mask is not None:
+        # strip the coordinates so that the mask is only broadcast by
+        # dimension name and not aligned on coordinate values
+        mask = xr.DataArray(mask.values, dims=mask.dims)
+        v = v.where(mask, other=0.0)
+
+    return fft.rfftn(v.values, axes=_horizontal_axes(v))
+
+def _centering_phase(shape, axes):
+    """
+    Phase-shift in Fourier space which rolls the real-space result by half the
+    domain along each of `axes`, so that the zero-lag is in the centre of the
+    domain without having to roll (and copy) the cumulant afterwards
+    """
+    phase = np.ones([1]*len(shape))
+    for n, ax in enumerate(axes):
+        N = shape[ax]
+        if n == len(axes) - 1:
+            # last axis is halved by the real-to-complex transform
+            k = np.arange(N//2 + 1)
+        else:
+            k = np.fft.fftfreq(N, d=1./N).astype(int)
+
+        if N % 2 == 0:
+            # exp(-i pi k) = (-1)^k when shifting by exactly half the domain
+            p = 1.0 - 2.0*(k % 2)
+        else:
+            p = np.exp(-2.j*pi*k*(N//2)/N)
+
+        s = [1]*len(shape)
+        s[ax] = len(k)
+        phase = phase*p.reshape(s)
+
+    return phase
+
+def _cumulant_from_spectra(V1, V2, shape, axes):
+    """
+    Compute the (centered) cumulant from the spectra `V1` and `V2` of two
+    fields with real-space `shape` transformed along `axes`
+    """
+    c_vv_fft = V1*V2.conjugate()
+    phase = _centering_phase(shape=shape, axes=axes)
+    c_vv_fft *= phase.astype(np.result_type(phase, c_vv_fft))
+
+    N = np.prod([shape[ax] for ax in axes])
+    c_vv = fft.irfftn(c_vv_fft, s=[shape[ax] for ax in axes], axes=axes)
+    # divide in-place so that single precision is kept
+    c_vv /= N
+
+    return c_vv
+
+def calc_2nd_cumulant(v1, v2=None, mask=None, single_precision=False):
     """
     Calculate 2nd-order cumulant of v1 and v2 in Fourier space. If mask is
     supplied the region outside the mask is set to the mean of the masked
     region, so that this region does not contribute to the cumulant
+
+    Any dimensions other than `x` and `y` (for example `zt` when passing in
+    a full 3D field) are treated as batch dimensions, so that the cumulant in
+    the horizontal is computed for all levels at once with a single
+    multi-axis real-to-complex transform
+
+    With `single_precision` the transforms and the returned cumulant are
+    float32/complex64, which halves the memory needed. See
+    `check_single_precision_accuracy` for how close this is to the float64
+    result
     """
     if v2 is not None:
         assert v1.shape == v2.shape
-    if v1.dims == ('x', 'y'):
-        Nx, Ny = v1.shape
-    else:
-        Ny, Nx = v1.shape
-
-    old_attrs = v1.attrs
-    v1 = v1 - v1.mean()
-    v1.attrs = old_attrs
-    if v2 is not None:
-        v2_old_attrs = v2.attrs
-        v2 = v2 - v2.mean()
-        v2.attrs = v2_old_attrs
+        assert v1.dims == v2.dims
 
     if mask is not None:
-        assert v1.shape == mask.shape
-        assert v1.dims == mask.dims
-
-        # set outside the masked region to the mean so that values in this
-        # region don't correlate with the rest of the domain
-        v1 = v1.where(mask.values, other=0.0)
+        assert all([d in v1.dims for d in mask.dims])
 
-        if v2 is not None:
-            v2 = v2.where(mask.values, other=0.0)
+    axes = _horizontal_axes(v1)
 
-    V1 = fft.fft2(v1)
+    V1 = _horizontal_spectrum(v1, mask=mask,
+                              single_precision=single_precision)
     if v2 is None:
         v2 = v1
         V2 = V1
     else:
-        V2 = fft.fft2(v2)
+        V2 = _horizontal_spectrum(v2, mask=mask,
+                                  single_precision=single_precision)
 
-    c_vv_fft = fft.ifft2(V1*V2.conjugate())
+    c_vv = _cumulant_from_spectra(V1, V2, shape=v1.shape, axes=axes)
 
-    # it's most handy to have this centered on (0,0)
-    c_vv = c_vv_fft.real/(Nx*Ny)
-    if v1.dims == ('x', 'y'):
-        c_vv = np.roll(
-            np.roll(c_vv, shift=int(Ny/2), axis=1),
-            shift=int(Nx/2), axis=0
-        )
-    else:
-        c_vv = np.roll(
-            np.roll(c_vv, shift=int(Ny/2), axis=0),
-            shift=int(Nx/2), axis=1
-        )
+    name, attrs = _cumulant_attrs(v1, v2, mask=mask)
 
+    return xr.DataArray(c_vv, dims=v1.dims, coords=v1.coords, attrs=attrs,
+                        name=name)
 
-    # let's give it a useful name and description
-    long_name = r"$C({},{})$".format(
-        _var_name_mapping.get(v1.name, v1.long_name),
-        _var_name_mapping.get(v2.name, v2.long_name),
-    )
-    v1_name = v1.name if v1.name is not None else v1.long_name
-    v2_name = v2.name if v2.name is not None else v2.long_name
-    name = "C({},{})".format(v1_name, v2_name)
+def calc_2nd_cumulants(fields, cumulants, mask=None, single_precision=False):
+    """
+    Calculate several 2nd-order cumulants from the fields in `fields` (a dict
+    of xarray.DataArray by name) for the pairs of field names in `cumulants`,
+    e.g. `[('w', 'w'), ('w', 'qv')]`. Each field is only transformed once and
+    every cumulant is formed from these shared spectra. The cumulants are
+    yielded one at a time (in the order of `cumulants`) so that only the
+    spectra are kept in memory. Masking, batch dimensions and
+    `single_precision` are handled as in `calc_2nd_cumulant`
+    """
+    field_names = []
+    for v1_name, v2_name in cumulants:
+        for v_name in [v1_name, v2_name]:
+            if not v_name in field_names:
+                field_names.append(v_name)
+
+    v_ref = fields[field_names[0]]
+    for v_name in field_names:
+        assert fields[v_name].shape == v_ref.shape
+        assert fields[v_name].dims == v_ref.dims
+
+    axes = _horizontal_axes(v_ref)
+
+    spectra = dict([
+        (v_name, _horizontal_spectrum(fields[v_name], mask=mask,
+                                      single_precision=single_precision))
+        for v_name in field_names
+    ])
 
-    if mask is not None:
-        long_name = "{} masked by {}".format(long_name, mask.long_name)
+    for v1_name, v2_name in cumulants:
+        v1, v2 = fields[v1_name], fields[v2_name]
+        c_vv = _cumulant_from_spectra(spectra[v1_name], spectra[v2_name],
+                                      shape=v1.shape, axes=axes)
 
-    attrs = dict(units="{} {}".format(v1.units, v2.units), long_name=long_name)
+        name, attrs = _cumulant_attrs(v1, v2, mask=mask)
 
-    return xr.DataArray(c_vv, dims=v1.dims, coords=v1.coords, attrs=attrs,
-                        name=name)
+        yield xr.DataArray(c_vv, dims=v1.dims, coords=v1.coords, attrs=attrs,
+                           name=name)
+
+def check_single_precision_accuracy(v1, v2=None, mask=None):
+    """
+    Compare the cumulant of `v1` and `v2` computed in single precision with
+    the float64 result. Returns the largest absolute difference relative to
+    the largest magnitude of the float64 cumulant (per level if `v1` has extra
+    dimensions). With float32 accumulation in the transforms this is
+    typically below 1e-6 (it grows only slowly, roughly with the log of the
+    number of points in the horizontal), much smaller than the sampling
+    uncertainty of the cumulant itself, so that the characteristic scales
+    agree to within a fraction of the grid spacing
+    """
+    C_vv = calc_2nd_cumulant(v1, v2, mask=mask)
+    C_vv_single = calc_2nd_cumulant(v1, v2, mask=mask, single_precision=True)
+
+    err = np.abs(C_vv_single - C_vv).max(dim=('x', 'y'))
+    err /= np.abs(C_vv).max(dim=('x', 'y'))
+    err.attrs['long_name'] = ("relative error of single precision "
+                              "{}".format(C_vv.name))
+
+    return err
 
 def identify_principle_axis(C, sI_N=100):
     """
@@ -186,6 +303,15 @@ def identify_principle_axis(C, sI_N=100):
         x, y = np.meshgrid(x_[sI_y], y_[sI_x], indexing='ij')
         I = I_func(x, y, s*C[sI_y, sI_x])
 
+    theta = _principle_axis_angle(I)
+
+    return xr.DataArray(theta, attrs=dict(units='radians'),
+                        coords=dict(zt=C.zt))
+
+def _principle_axis_angle(I):
+    """
+    Angle of the principle axis from the inertia tensor `I`
+    """
     la, v = np.linalg.eig(I)
 
     # sort eigenvectors by eigenvalue, the largest eigenvalue will be the
@@ -211,8 +337,65 @@ def identify_principle_axis(C, sI_N=100):
     if theta < 0.0:
         theta += pi
 
-    return xr.DataArray(theta, attrs=dict(units='radians'),
-                        coords=dict(zt=C.zt))
+    return theta
+
+def calc_moment_tables(C):
+    """
+    Compute summed-area tables (integral images) of the moments C, C*x, C*y,
+    C*x^2, C*y^2 and C*x*y of the 2D cumulant `C`, so that the moments (and
+    so the inertia tensor) over any rectangular window can be found in O(1)
+    with `_window_sum`. The cumulant is multiplied by the sign at the origin
+    so that anti-correlation has positive "mass" (as in
+    `identify_principle_axis`)
+    """
+    C = C.transpose('x', 'y')
+    Nx, Ny = C.shape
+
+    x, y = np.meshgrid(C.x.values, C.y.values, indexing='ij')
+    m = np.sign(C.values[Nx//2, Ny//2])*C.values
+
+    moments = dict(
+        m=m, mx=m*x, my=m*y, mxx=m*x**2., myy=m*y**2., mxy=m*x*y
+    )
+
+    tables = {}
+    for k, v in moments.items():
+        table = np.zeros((Nx+1, Ny+1))
+        table[1:,1:] = np.cumsum(np.cumsum(v, axis=0), axis=1)
+        tables[k] = table
+
+    return tables
+
+def _window_sum(table, sx, sy):
+    """
+    Sum over the window given by slices `sx` and `sy` using the summed-area
+    `table`
+    """
+    return (table[sx.stop, sy.stop] - table[sx.start, sy.stop]
+            - table[sx.stop, sy.start] + table[sx.start, sy.start])
+
+def identify_principle_axis_from_moments(moment_tables, sI_N=100):
+    """
+    Identify principle axis of correlation in 2D in a centered window of
+    width `sI_N` using the summed-area tables from `calc_moment_tables`. This
+    gives the same angle as `identify_principle_axis` but at constant cost for
+    any window size
+    """
+    Nx, Ny = moment_tables['m'].shape[0] - 1, moment_tables['m'].shape[1] - 1
+
+    sI_x = slice(max(Nx//2 - sI_N//2, 0), min(Nx//2 + sI_N//2, Nx))
+    sI_y = slice(max(Ny//2 - sI_N//2, 0), min(Ny//2 + sI_N//2, Ny))
+
+    I_xx = _window_sum(moment_tables['mxx'], sI_x, sI_y)
+    I_yy = _window_sum(moment_tables['myy'], sI_x, sI_y)
+    I_xy = _window_sum(moment_tables['mxy'], sI_x, sI_y)
+
+    I = np.array([
+        [I_yy, I_xy],
+        [I_xy, I_xx],
+    ])
+
+    return _principle_axis_angle(I)
 
 def _extract_cumulant_center(C_vv):
     """
@@ -435,6 +618,10 @@ def _find_width_through_mass_weighting(data, theta, max_width=5000.,
             raise Exception("No valid datapoints found")
         elif np.min(vals_) < 0.0:
             max_width_local = x_[np.argmin(vals_)]
+            # NB: `max_width_local` is already negative in the backward
+            # direction, so these limits span the forward direction instead.
+            # Kept as is for reproducibility, `calc_widths` integrates the
+            # backward direction
             if dir == 1:
                 kw = dict(a=0, b=max_width_local)
             else:
@@ -518,6 +705,269 @@ def _find_width_through_cutoff(data, theta, width_peak_fraction=0.5,
     return xr.DataArray(width, coords=dict(zt=data.zt), attrs=dict(units='m'))
 
 
+def _sample_lines(C_vv, theta, mu):
+    """
+    Sample the cumulant `C_vv` along lines through the origin at angles
+    `theta` (xarray.DataArray in radians) at the distances `mu` with a single
+    (linear) `map_coordinates` call. `C_vv` may have extra dimensions (e.g.
+    `zt`) and `theta` may be given for each of these, or have extra
+    dimensions (e.g. a set of angles). Returns the samples with the last
+    dimension being along `mu` and the broadcast angles
+    """
+    lev_dims = [d for d in C_vv.dims if not d in ('x', 'y')]
+    C_vv = C_vv.transpose('x', 'y', *lev_dims)
+
+    if not isinstance(theta, xr.DataArray):
+        theta = xr.DataArray(theta)
+    lev_template = C_vv.isel(x=0, y=0, drop=True).reset_coords(drop=True)
+    theta = theta.broadcast_like(lev_template)
+    theta = theta.transpose(*[d for d in theta.dims if not d in lev_dims],
+                            *lev_dims)
+
+    theta_ = theta.values[..., None]
+    x_ = np.cos(theta_)*mu
+    y_ = np.sin(theta_)*mu
+
+    # map (x, y)-positions to fractional indices, clipping to the domain
+    x, y = C_vv.x.values, C_vv.y.values
+    coords = [
+        np.interp(x_, x, np.arange(len(x))),
+        np.interp(y_, y, np.arange(len(y))),
+    ]
+    for n, d in enumerate(lev_dims):
+        s = [1]*x_.ndim
+        s[x_.ndim - len(lev_dims) - 1 + n] = C_vv[d].size
+        idx = np.arange(C_vv[d].size).reshape(s)
+        coords.append(np.broadcast_to(idx, x_.shape))
+
+    vals = scipy.ndimage.map_coordinates(
+        C_vv.values, np.array(coords), order=1, mode='nearest'
+    )
+
+    return vals, theta
+
+
+def _trapz(f, dx):
+    return np.sum(0.5*(f[..., 1:] + f[..., :-1]), axis=-1)*dx
+
+
+def _mass_weighted_edge(vals, mu):
+    """
+    Mass-weighted distance of positive (or negative if the origin is
+    negative) correlation along the last axis of `vals` (sampled at distances
+    `mu` from the origin). If the correlation changes sign the integration
+    only extends to the first minimum so that correlating regions further out
+    are excluded. Returns the distance and the integrated "mass"
+    """
+    s = np.sign(vals[..., :1])
+    vals = s*vals
+
+    i_min = np.argmin(vals, axis=-1)
+    has_neg = np.min(vals, axis=-1) < 0.0
+    i_lim = np.where(has_neg, i_min, len(mu) - 1)
+    in_range = np.arange(len(mu)) <= i_lim[..., None]
+
+    fn = np.where(in_range, np.maximum(0.0, vals), 0.0)
+
+    dmu = mu[1] - mu[0]
+    mass = _trapz(fn, dmu)
+    inertia = _trapz(fn*mu, dmu)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = np.where(mass > 0.0, inertia/mass, np.nan)
+
+    return dist, mass
+
+
+def _cutoff_edge(vals, mu, width_peak_fraction):
+    """
+    Distance along last axis of `vals` (sampled at distances `mu`) at which
+    `vals` first drops below `width_peak_fraction` (found by linear
+    interpolation). Returns inf where no crossing is found before the
+    values turn negative or the end of the sampled range is reached
+    """
+    f = vals - width_peak_fraction
+
+    below = f < 0.0
+    i_cross = np.argmax(below, axis=-1)
+    has_cross = np.logical_and(np.any(below, axis=-1), i_cross > 0)
+    i_cross = np.maximum(i_cross, 1)
+
+    f_l = np.take_along_axis(f, (i_cross - 1)[..., None], axis=-1)[..., 0]
+    f_r = np.take_along_axis(f, i_cross[..., None], axis=-1)[..., 0]
+    mu_l, mu_r = mu[i_cross - 1], mu[i_cross]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu_cross = mu_l + f_l/(f_l - f_r)*(mu_r - mu_l)
+
+    return np.where(has_cross, mu_cross, np.inf)
+
+
+def _line_sample_distances(C_vv, width_est_method, max_width,
+                           samples_per_cell):
+    """
+    Distances from the origin at which to sample the cumulant for the given
+    width estimation method
+    """
+    assert C_vv.x.units == 'm'
+    dx = np.max(np.gradient(C_vv.x.values))
+
+    if width_est_method == WidthEstimationMethod.MASS_WEIGHTED:
+        mu_max = max_width/2.
+    elif width_est_method == WidthEstimationMethod.CUTOFF:
+        mu_max = max_width
+    else:
+        raise NotImplementedError(width_est_method)
+
+    n_mu = int(np.ceil(mu_max/dx*samples_per_cell))
+    return np.linspace(0., mu_max, n_mu + 1)
+
+
+def _widths_from_line_samples(vals_fwd, vals_bwd, mu, width_est_method,
+                              d_max=None, width_peak_fraction=0.5,
+                              max_width=5000.):
+    """
+    Compute widths (and the integrated mass) from the cumulant sampled at
+    distances `mu` in both directions along a set of lines through the origin
+    """
+    edge_fwd, mass_fwd = _mass_weighted_edge(vals_fwd, mu)
+    edge_bwd, mass_bwd = _mass_weighted_edge(vals_bwd, mu)
+    mass = mass_fwd + mass_bwd
+
+    if width_est_method == WidthEstimationMethod.MASS_WEIGHTED:
+        width = edge_fwd + edge_bwd
+    else:
+        width = (_cutoff_edge(vals_fwd/d_max, mu, width_peak_fraction)
+                 + _cutoff_edge(vals_bwd/d_max, mu, width_peak_fraction))
+
+        if np.any(np.isinf(width)):
+            warnings.warn("Couldn't find width smaller than `{}` assuming"
+                          " that the cumulant spreads to infinity".format(
+                          max_width))
+
+    return width, mass
+
+
+def calc_widths(C_vv, theta, width_est_method=None, max_width=5000.,
+                width_peak_fraction=0.5, samples_per_cell=4):
+    """
+    Vectorised estimate of the width of the cumulant `C_vv` along the lines
+    at angles `theta` (in radians). Each line is sampled once on a fixed grid
+    (with `samples_per_cell` points per grid cell), the mass-weighted width is
+    computed with the trapezoidal rule and the cut-off width by linear
+    interpolation of the crossing of `width_peak_fraction` of the peak value.
+
+    `C_vv` can contain extra dimensions (for example a cumulant computed for
+    all levels) and `theta` may vary along these and/or have extra
+    dimensions of its own (for example a set of sample angles), so that the
+    widths for many angles and levels are computed at once
+
+    NB: unlike `_find_width_through_mass_weighting` the backward mass-weighted
+    edge is integrated along the backward direction when the correlation
+    changes sign there (the quadrature limits of the former then span the
+    forward direction up to the distance of the backward minimum). This
+    changes the mass-weighted widths of cross-cumulants (auto-cumulants are
+    symmetric and unaffected)
+    """
+    if width_est_method is None:
+        width_est_method = WidthEstimationMethod.MASS_WEIGHTED
+
+    mu = _line_sample_distances(C_vv, width_est_method=width_est_method,
+                                max_width=max_width,
+                                samples_per_cell=samples_per_cell)
+    n_mu = len(mu) - 1
+
+    # sample both directions along the line at once
+    vals, theta_b = _sample_lines(C_vv, theta=theta,
+                                  mu=np.concatenate([-mu[::-1], mu[1:]]))
+    vals_fwd = vals[..., n_mu:]
+    vals_bwd = vals[..., n_mu::-1]
+
+    d_max = None
+    if width_est_method == WidthEstimationMethod.CUTOFF:
+        d_max = C_vv.max(dim=('x', 'y')).broadcast_like(theta_b)
+        d_max = d_max.transpose(*theta_b.dims).values[..., None]
+
+    width, _ = _widths_from_line_samples(
+        vals_fwd, vals_bwd, mu=mu, width_est_method=width_est_method,
+        d_max=d_max, width_peak_fraction=width_peak_fraction,
+        max_width=max_width
+    )
+
+    return xr.DataArray(width, dims=theta_b.dims, coords=theta_b.coords,
+                        attrs=dict(units='m'))
+
+
+def resample_polar(C_vv, theta, r):
+    """
+    Resample the cumulant `C_vv` onto a polar grid (`r`, `theta`) centred on
+    the origin with a single interpolation call. Any extra dimensions of
+    `C_vv` (e.g. `zt`) are kept
+    """
+    da_theta = xr.DataArray(theta, dims=('theta',), coords=dict(theta=theta),
+                            attrs=dict(units='radians'))
+    vals, theta_b = _sample_lines(C_vv, theta=da_theta, mu=r)
+
+    coords = dict(theta_b.coords)
+    coords['r'] = xr.DataArray(r, dims=('r',), attrs=dict(units='m'))
+    coords['theta'] = da_theta
+
+    return xr.DataArray(vals, dims=theta_b.dims + ('r',), coords=coords,
+                        attrs=C_vv.attrs, name=C_vv.name)
+
+
+def calc_polar_scales(C_vv, n_theta=36, width_est_method=None,
+                      max_width=5000., width_peak_fraction=0.5,
+                      samples_per_cell=4):
+    """
+    Compute the width and integrated "mass" (of the part with the same sign as
+    at the origin) of the cumulant `C_vv` along `n_theta` lines through the
+    origin with angles in [0, 180) degrees. The cumulant is resampled onto a
+    polar grid once, so that these anisotropy "roses" can be computed for all
+    levels (if `C_vv` has a `zt` dimension) at once
+    """
+    if width_est_method is None:
+        width_est_method = WidthEstimationMethod.MASS_WEIGHTED
+
+    r = _line_sample_distances(C_vv, width_est_method=width_est_method,
+                               max_width=max_width,
+                               samples_per_cell=samples_per_cell)
+    # sample the full circle so that both directions along every line are
+    # included
+    theta = np.linspace(0., 2.*pi, 2*n_theta, endpoint=False)
+
+    # dimensions of the resampled cumulant are (theta, [levels,] r)
+    da_polar = resample_polar(C_vv, theta=theta, r=r)
+    vals = da_polar.values
+    vals_fwd, vals_bwd = vals[:n_theta], vals[n_theta:]
+
+    da_theta = da_polar.theta.isel(theta=slice(0, n_theta))
+    template = da_polar.isel(theta=slice(0, n_theta), r=0, drop=True)
+
+    d_max = None
+    if width_est_method == WidthEstimationMethod.CUTOFF:
+        d_max = C_vv.max(dim=('x', 'y')).broadcast_like(template)
+        d_max = d_max.transpose(*template.dims).values[..., None]
+
+    width, mass = _widths_from_line_samples(
+        vals_fwd, vals_bwd, mu=r, width_est_method=width_est_method,
+        d_max=d_max, width_peak_fraction=width_peak_fraction,
+        max_width=max_width
+    )
+
+    ds = xr.Dataset(coords=template.coords)
+    ds['width'] = (template.dims, width, dict(units='m'))
+    ds['mass'] = (template.dims, mass,
+                  dict(units="{} m".format(C_vv.attrs.get('units', '')).strip(),
+                       long_name='integrated correlation along line'))
+    ds['theta_deg'] = da_theta*180./pi
+    ds.theta_deg.attrs['units'] = 'deg'
+    if C_vv.name is not None:
+        ds['cumulant'] = C_vv.name
+
+    return ds
+
+
 def covariance_direction_plot(v1, v2, s_N=200, theta_win_N=100,
                               width_peak_fraction=0.5, mask=None,
                               max_dist=2000., with_45deg_sample=False,
@@ -604,45 +1054,136 @@ def covariance_direction_plot(v1, v2, s_N=200, theta_win_N=100,
 
 def charactistic_scales(v1, v2=None, l_theta_win=1000., mask=None,
                         sample_angle=None,
-                        width_est_method=WidthEstimationMethod.MASS_WEIGHTED):
+                        width_est_method=WidthEstimationMethod.MASS_WEIGHTED,
+                        vectorised_widths=False, single_precision=False):
     """
     From 2nd-order cumulant of v1 and v2 compute principle axis angle,
     characteristic length-scales along and perpendicular to principle axis (as
-    full width at half maximum)
+    full width at half maximum). See `scales_from_cumulant` for
+    `vectorised_widths`
     """
-    import matplotlib.pyplot as plot
-
     if v2 is not None:
         assert v1.shape == v2.shape
         assert np.all(v1.coords['x'] == v2.coords['x'])
         assert np.all(v1.coords['y'] == v2.coords['y'])
 
-    if width_est_method == WidthEstimationMethod.CUTOFF:
+    C_vv = calc_2nd_cumulant(v1, v2, mask=mask,
+                             single_precision=single_precision)
+
+    return scales_from_cumulant(C_vv=C_vv, l_theta_win=l_theta_win,
+                                sample_angle=sample_angle,
+                                width_est_method=width_est_method,
+                                vectorised_widths=vectorised_widths)
+
+def _principle_axis_window_sweep(C_vv, l_theta_win, width_est_method,
+                                 n_windows_max=10):
+    """
+    Find the principle axis and widths along and perpendicular to it by
+    sweeping over window sizes (starting at `l_theta_win` and growing by 20%
+    each time) used for identifying the principle axis. The first window for
+    which the principle axis is not much narrower than the perpendicular
+    direction is used. The inertia tensor for every window is computed from
+    summed-area moment tables and the widths for all windows with a single
+    call to `calc_widths`
+    """
+    dx = np.max(np.gradient(C_vv.x))
+
+    moment_tables = calc_moment_tables(C_vv)
+
+    l_wins = l_theta_win*1.2**np.arange(n_windows_max + 1)
+    thetas = np.array([
+        identify_principle_axis_from_moments(moment_tables,
+                                             sI_N=int(l_win/dx)*2)
+        for l_win in l_wins
+    ])
+
+    da_theta = xr.DataArray(thetas, dims=('window',))
+    da_theta_dirs = xr.concat([da_theta, da_theta + pi/2.], dim='direction')
+    widths = calc_widths(C_vv.reset_coords(drop=True), da_theta_dirs,
+                         width_est_method=width_est_method)
+    widths_principle = widths.isel(direction=0).values
+    widths_perpendicular = widths.isel(direction=1).values
+
+    for n in range(len(l_wins)):
+        w_pr, w_pe = widths_principle[n], widths_perpendicular[n]
+
+        if np.isnan(w_pe) or np.isnan(w_pr):
+            break
+
+        d_width = np.abs(w_pe - w_pr)
+        mean_width = 0.5*(w_pe + w_pr)
+
+        if not (d_width/mean_width > 0.30 and w_pe > w_pr):
+            break
+    else:
+        warnings.warn("Couldn't find principle axis")
+        n = None
+
+    def _make_da(v, units):
+        return xr.DataArray(v, attrs=dict(units=units),
+                            coords=dict(zt=C_vv.zt))
+
+    if n is None:
+        return (_make_da(np.nan, 'radians'), _make_da(np.nan, 'm'),
+                _make_da(np.nan, 'm'))
+    else:
+        return (_make_da(thetas[n], 'radians'),
+                _make_da(widths_principle[n], 'm'),
+                _make_da(widths_perpendicular[n], 'm'))
+
+def scales_from_cumulant(C_vv, l_theta_win=1000., sample_angle=None,
+                         width_est_method=WidthEstimationMethod.MASS_WEIGHTED,
+                         vectorised_widths=False):
+    """
+    Compute principle axis angle and characteristic length-scales along and
+    perpendicular to principle axis from a precomputed 2D cumulant `C_vv` (for
+    example a single level of a cumulant computed for all levels at once).
+    With `vectorised_widths` the widths are estimated with `calc_widths`
+    rather than by adaptive quadrature and root-finding on an interpolator.
+    This corrects the backward edge of the mass-weighted widths (see
+    `calc_widths`), which changes the widths of cross-cumulants, and so is
+    not used by default to keep results consistent with earlier output
+    """
+    if vectorised_widths:
+        def width_func(C_vv, theta):
+            return calc_widths(C_vv, theta, width_est_method=width_est_method)
+    elif width_est_method == WidthEstimationMethod.CUTOFF:
         width_func = _find_width_through_cutoff
     elif width_est_method == WidthEstimationMethod.MASS_WEIGHTED:
         width_func = _find_width_through_mass_weighting
     else:
         raise NotImplementedError
 
-    Nx, Ny = v1.shape
+    Nx, Ny = C_vv.shape
 
-    dx = np.max(np.gradient(v1.x))
-
-    C_vv = calc_2nd_cumulant(v1, v2, mask=mask)
+    dx = np.max(np.gradient(C_vv.x))
 
     l_win = l_theta_win
     found_min_max_lengths = False
     m = 0
     if sample_angle is not None:
         theta = xr.DataArray(sample_angle*pi/180., attrs=dict(units='radians'),
-                        coords=dict(zt=v1.zt))
+                        coords=dict(zt=C_vv.zt))
 
         width_principle_axis = width_func(C_vv, theta)
         width_perpendicular = width_func(C_vv, theta+pi/2.)
+    elif vectorised_widths:
+        theta, width_principle_axis, width_perpendicular = \
+            _principle_axis_window_sweep(
+                C_vv=C_vv, l_theta_win=l_theta_win,
+                width_est_method=width_est_method
+            )
     else:
+        # the moments over every window size come from the same tables, so
+        # that growing the window doesn't require recomputing the moments
+        moment_tables = calc_moment_tables(C_vv)
         while True:
             s_N = int(l_win/dx)*2
-            theta = identify_principle_axis(C_vv, sI_N=s_N)
+            theta = xr.DataArray(
+                identify_principle_axis_from_moments(moment_tables,
+                                                     sI_N=s_N),
+                attrs=dict(units='radians'), coords=dict(zt=C_vv.zt)
+            )
 
             width_principle_axis = width_func(C_vv, theta)
             width_perpendicular = width_func(C_vv, theta+pi/2.)
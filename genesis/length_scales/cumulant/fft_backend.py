@@ -0,0 +1,193 @@
+"""
+Configurable backend for the Fourier transforms used in the cumulant analysis.
+One of `pyfftw`, `scipy` (scipy.fft) or `numpy` (numpy.fft) can be used, with
+the number of threads set for the backends which support it. When using pyfftw
+the FFTW wisdom (the plans created for each transform size) can be persisted
+to disk so that freshly spawned (e.g. luigi worker) processes don't have to
+re-plan the same transforms.
+
+The backend can be set with `configure(...)` or through the environment
+variables `GENESIS_FFT_BACKEND`, `GENESIS_FFT_THREADS` and
+`GENESIS_FFT_WISDOM` (path of the wisdom file) which are read on first use.
+
+pyfftw and scipy.fft keep float32/complex64 input in single precision, numpy.fft
+always computes in double precision (the result is cast back to single
+precision), so use one of the former to save memory with single precision.
+"""
+import os
+import pickle
+import tempfile
+import warnings
+
+import numpy as np
+
+BACKENDS = ['pyfftw', 'scipy', 'numpy']
+SINGLE_PRECISION_TYPES = [np.float32, np.complex64]
+
+_config = dict(
+    backend=None,
+    threads=None,
+    wisdom_file=None,
+    planner_effort='FFTW_MEASURE',
+)
+
+_state = dict(module=None, wisdom=None)
+
+
+def _find_available_backend():
+    for backend in BACKENDS:
+        try:
+            _import_backend(backend)
+            return backend
+        except ImportError:
+            pass
+    raise Exception("No FFT backend available")
+
+
+def _import_backend(backend):
+    if backend == 'pyfftw':
+        import pyfftw
+        import pyfftw.interfaces.numpy_fft
+        pyfftw.interfaces.cache.enable()
+        return pyfftw.interfaces.numpy_fft
+    elif backend == 'scipy':
+        import scipy.fft
+        return scipy.fft
+    elif backend == 'numpy':
+        import numpy.fft
+        return numpy.fft
+    else:
+        raise NotImplementedError("FFT backend `{}` not recognised, should be"
+                                  " one of {}".format(backend,
+                                                      ", ".join(BACKENDS)))
+
+
+def configure(backend=None, threads=None, wisdom_file=None,
+              planner_effort=None):
+    """
+    Set the FFT backend (one of `pyfftw`, `scipy` or `numpy`), the number of
+    threads to use and the file where pyfftw wisdom is persisted. Arguments
+    left as None keep their current value
+    """
+    if backend is not None:
+        if not backend in BACKENDS:
+            raise NotImplementedError("FFT backend `{}` not recognised, should"
+                                      " be one of {}".format(
+                                          backend, ", ".join(BACKENDS)))
+        _config['backend'] = backend
+        _state['module'] = None
+    if threads is not None:
+        _config['threads'] = int(threads)
+    if wisdom_file is not None:
+        _config['wisdom_file'] = wisdom_file
+        _state['wisdom'] = None
+    if planner_effort is not None:
+        _config['planner_effort'] = planner_effort
+
+
+def get_backend():
+    """
+    Return the name of the FFT backend in use, selecting it (from the
+    environment or the first available) if this hasn't been done yet
+    """
+    if _state['module'] is None:
+        if _config['backend'] is None:
+            backend = os.environ.get('GENESIS_FFT_BACKEND')
+            if backend is None:
+                backend = _find_available_backend()
+            _config['backend'] = backend
+        if _config['threads'] is None:
+            _config['threads'] = int(os.environ.get('GENESIS_FFT_THREADS', 1))
+        if _config['wisdom_file'] is None:
+            _config['wisdom_file'] = os.environ.get('GENESIS_FFT_WISDOM')
+
+        _state['module'] = _import_backend(_config['backend'])
+        print("Using {} FFT backend with {} thread(s)".format(
+            _config['backend'], _config['threads']
+        ))
+
+        if _config['backend'] == 'pyfftw':
+            load_wisdom()
+
+    return _config['backend']
+
+
+def load_wisdom():
+    """
+    Load pyfftw wisdom from the configured wisdom file (if it exists)
+    """
+    import pyfftw
+
+    fn = _config['wisdom_file']
+    if fn is None or not os.path.exists(fn):
+        return
+
+    try:
+        with open(fn, 'rb') as fh:
+            wisdom = pickle.load(fh)
+        pyfftw.import_wisdom(wisdom)
+        _state['wisdom'] = pyfftw.export_wisdom()
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        warnings.warn("Couldn't load FFTW wisdom from `{}`: {}".format(fn, e))
+
+
+def save_wisdom():
+    """
+    Store the current pyfftw wisdom in the configured wisdom file if it has
+    changed since it was last loaded or saved. The file is replaced atomically
+    so that several processes can share the same file
+    """
+    import pyfftw
+
+    fn = _config['wisdom_file']
+    if fn is None:
+        return
+
+    wisdom = pyfftw.export_wisdom()
+    if wisdom == _state['wisdom']:
+        return
+
+    p_dir = os.path.dirname(os.path.abspath(fn))
+    os.makedirs(p_dir, exist_ok=True)
+    fh, fn_tmp = tempfile.mkstemp(dir=p_dir, suffix='.tmp')
+    with os.fdopen(fh, 'wb') as fh:
+        pickle.dump(wisdom, fh)
+    os.replace(fn_tmp, fn)
+
+    _state['wisdom'] = wisdom
+
+
+def _transform_kwargs():
+    backend = get_backend()
+    if backend == 'pyfftw':
+        return dict(threads=_config['threads'],
+                    planner_effort=_config['planner_effort'])
+    elif backend == 'scipy':
+        return dict(workers=_config['threads'])
+    else:
+        return dict()
+
+
+def _transform(fn_name, a, *args, **kwargs):
+    kwargs.update(_transform_kwargs())
+    result = getattr(_state['module'], fn_name)(a, *args, **kwargs)
+
+    if _config['backend'] == 'pyfftw':
+        save_wisdom()
+    elif _config['backend'] == 'numpy' and a.dtype in SINGLE_PRECISION_TYPES:
+        # numpy.fft always computes in double precision, so at least return
+        # the result in the precision the input was given in
+        if fn_name == 'irfftn':
+            result = result.astype(np.float32)
+        else:
+            result = result.astype(np.complex64)
+
+    return result
+
+
+def rfftn(a, axes=None):
+    return _transform('rfftn', a, axes=axes)
+
+
+def irfftn(a, s=None, axes=None):
+    return _transform('irfftn', a, s=s, axes=axes)
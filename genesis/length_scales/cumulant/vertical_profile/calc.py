@@ -3,7 +3,10 @@ Utility script to process all 3D dataset and calculate cumulant length-scales
 in 2D domain-wide cross-sections
 """
 import os
+import shutil
+import tempfile
 import warnings
+from multiprocessing import Pool
 
 import xarray as xr
 import numpy as np
@@ -12,6 +15,11 @@ from tqdm import tqdm
 from collections import OrderedDict
 
 from .. import calc as cumulant_analysis
+from ....utils import level_store
+
+# number of levels for which the cumulants are computed at once, this bounds
+# the memory used to a few levels of each field (and their spectra)
+Z_BATCH_SIZE = 8
 
 
 def z_center_field(phi_da):
@@ -71,45 +79,72 @@ def _extract_horizontal(da, z):
         da_slice = da.where(da.zt==z, drop=True).squeeze()
         da_slice.name = da.name
     else:
-        fn = da.from_file
+        # read from the level-chunked copy of the field so that only the
+        # chunk for this level is read
+        da_levels = level_store.get_level_store(da)
+        if 'time' in da_levels.dims:
+            da_levels = da_levels.isel(time=0, drop=True)
 
-        fn_slice = os.path.join(
-            os.path.dirname(fn),
-            'k-slices',
-            os.path.basename(fn).replace('.nc', '.z{}m.nc'.format(z.values))
-        )
+        da_slice = da_levels.sel(zt=z)
+        da_slice.name = da.name
 
-        if not os.path.exists(os.path.dirname(fn_slice)):
-            raise Exception("Remember to symlink k-slices into `{}`".format(
-                os.path.dirname(fn)
-            ))
+    return da_slice
 
 
-        if not os.path.exists(fn_slice):
-            da_slice = da.isel(time=0, drop=True)\
-                         .where(da.zt==z, drop=True).squeeze()
+def _extract_levels(da, z):
+    """
+    Extract the horizontal cross-sections at heights `z` from `da` as a single
+    (x, y, zt) block so that the cumulants can be computed for all levels at
+    once
+    """
+    if hasattr(da, 'from_file'):
+        da = level_store.get_level_store(da)
 
-            # copy over the shorthand name so that they can be used when naming the
-            # cumulant
-            da_slice.name = da.name
+    if 'time' in da.dims:
+        da = da.isel(time=0)
 
-            da_slice.to_netcdf(fn_slice)
-            da_slice.close()
+    da_levels = da.sel(zt=z)
+    da_levels = da_levels.rename(dict(xt='x', yt='y'))
+    da_levels.attrs.update(da.attrs)
+    # copy over the shorthand name so that they can be used when naming the
+    # cumulant
+    da_levels.name = da.name
 
-        da_slice = xr.open_dataarray(fn_slice, decode_times=False)
-        # da_slice = da_slice.transpose('xt', 'yt')
+    return da_levels.load()
 
-    return da_slice
 
+def _extract_mask_levels(mask, z):
+    """
+    Extract the mask at heights `z` (if the mask varies with height) for
+    use with `_extract_levels`
+    """
+    if mask is None:
+        return None
 
-def get_height_variation_of_characteristic_scales(
-        v1_3d, z_max,
-        width_method=cumulant_analysis.WidthEstimationMethod.MASS_WEIGHTED,
-        v2_3d=None, z_min=0.0, mask=None, sample_angle=None):
+    mask_levels = mask
+    if 'time' in mask_levels.dims:
+        mask_levels = mask_levels.isel(time=0)
+    if 'zt' in mask_levels.dims:
+        mask_levels = mask_levels.sel(zt=z)
+    mask_levels = mask_levels.rename(dict(xt='x', yt='y'))
+    mask_levels.attrs.update(mask.attrs)
 
-    datasets = []
+    return mask_levels
+
+
+def _iterate_level_batches(z_, z_batch_size=Z_BATCH_SIZE):
+    if z_batch_size is None:
+        z_batch_size = len(z_)
+
+    for k in range(0, len(z_), z_batch_size):
+        yield z_[k:k+z_batch_size]
 
-    z_ = v1_3d.zt[np.logical_and(v1_3d.zt > z_min, v1_3d.zt <= z_max)]
+
+def _get_height_variation_per_level(v1_3d, z_, width_method, v2_3d=None,
+                                    mask=None, sample_angle=None,
+                                    single_precision=False,
+                                    vectorised_widths=False):
+    datasets = []
 
     for z in tqdm(z_):
         v1 = _extract_horizontal(v1_3d, z=z)
@@ -134,10 +169,233 @@ def get_height_variation_of_characteristic_scales(
 
         scales = cumulant_analysis.charactistic_scales(v1=v1, v2=v2, mask=mask_2d,
                                                        sample_angle=sample_angle,
-                                                       width_est_method=width_method)
+                                                       width_est_method=width_method,
+                                                       single_precision=single_precision,
+                                                       vectorised_widths=vectorised_widths)
 
         datasets.append(scales)
 
+    return datasets
+
+
+def _get_height_variation_batched(v1_3d, z_, width_method, v2_3d=None,
+                                  mask=None, sample_angle=None,
+                                  z_batch_size=Z_BATCH_SIZE,
+                                  single_precision=False,
+                                  vectorised_widths=False):
+    datasets = []
+
+    pbar = tqdm(total=len(z_))
+    for z_batch in _iterate_level_batches(z_, z_batch_size=z_batch_size):
+        v1 = _extract_levels(v1_3d, z=z_batch)
+        if v2_3d is None:
+            v2 = None
+        else:
+            v2 = _extract_levels(v2_3d, z=z_batch)
+
+        mask_levels = _extract_mask_levels(mask, z=z_batch)
+
+        C_vv = cumulant_analysis.calc_2nd_cumulant(
+            v1, v2, mask=mask_levels, single_precision=single_precision
+        )
+
+        for k in range(len(z_batch)):
+            scales = cumulant_analysis.scales_from_cumulant(
+                C_vv=C_vv.isel(zt=k), sample_angle=sample_angle,
+                width_est_method=width_method,
+                vectorised_widths=vectorised_widths
+            )
+            datasets.append(scales)
+            pbar.update(1)
+    pbar.close()
+
+    return datasets
+
+
+def _get_shared_dir():
+    # put the memory-mapped levels in shared memory if we can
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    else:
+        return None
+
+
+def _write_levels_to_memmap(da, z_, fn, z_batch_size=Z_BATCH_SIZE):
+    """
+    Write the levels `z_` of `da` to a memory-mapped file `fn` (extracting
+    `z_batch_size` levels at a time) and return the information needed to
+    open the levels again as a xarray.DataArray in another process
+    """
+    arr = None
+    k = 0
+    for z_batch in _iterate_level_batches(z_, z_batch_size=z_batch_size):
+        da_batch = _extract_levels(da, z=z_batch)
+        k_ax = da_batch.dims.index('zt')
+        if arr is None:
+            shape = list(da_batch.shape)
+            shape[k_ax] = len(z_)
+            arr = np.memmap(fn, dtype=da_batch.dtype, mode='w+',
+                            shape=tuple(shape))
+            da_ref = da_batch
+        slices = [slice(None)]*arr.ndim
+        slices[k_ax] = slice(k, k+len(z_batch))
+        arr[tuple(slices)] = da_batch.values
+        k += len(z_batch)
+    arr.flush()
+
+    coords = dict(da_ref.coords)
+    coords['zt'] = z_
+
+    return dict(fn=fn, dtype=arr.dtype.str, shape=arr.shape,
+                dims=da_ref.dims, coords=coords, attrs=da_ref.attrs,
+                name=da_ref.name)
+
+
+def _open_memmap_levels(info):
+    values = np.memmap(info['fn'], dtype=info['dtype'], mode='r',
+                       shape=info['shape'])
+    return xr.DataArray(values, dims=info['dims'], coords=info['coords'],
+                        attrs=info['attrs'], name=info['name'])
+
+
+_worker_state = {}
+
+
+def _init_level_worker(fields_info, mask, cumulants, sample_angle,
+                       width_method, single_precision, vectorised_widths):
+    _worker_state['fields'] = dict([
+        (v_name, _open_memmap_levels(info))
+        for (v_name, info) in fields_info.items()
+    ])
+    _worker_state['mask'] = mask
+    _worker_state['cumulants'] = cumulants
+    _worker_state['sample_angle'] = sample_angle
+    _worker_state['width_method'] = width_method
+    _worker_state['single_precision'] = single_precision
+    _worker_state['vectorised_widths'] = vectorised_widths
+
+
+def _scales_for_level(k):
+    fields = dict([
+        (v_name, da.isel(zt=k))
+        for (v_name, da) in _worker_state['fields'].items()
+    ])
+
+    mask = _worker_state['mask']
+    if mask is not None and 'zt' in mask.dims:
+        mask = mask.isel(zt=k)
+
+    cumulants_level = cumulant_analysis.calc_2nd_cumulants(
+        fields=fields, cumulants=_worker_state['cumulants'], mask=mask,
+        single_precision=_worker_state['single_precision']
+    )
+
+    datasets = []
+    for C_vv in cumulants_level:
+        scales = cumulant_analysis.scales_from_cumulant(
+            C_vv=C_vv, sample_angle=_worker_state['sample_angle'],
+            width_est_method=_worker_state['width_method'],
+            vectorised_widths=_worker_state['vectorised_widths']
+        )
+        datasets.append(scales.load())
+
+    return k, datasets
+
+
+def _get_height_variation_parallel(fields, cumulants, z_, width_method,
+                                   mask=None, sample_angle=None,
+                                   n_workers=None,
+                                   z_batch_size=Z_BATCH_SIZE,
+                                   single_precision=False,
+                                   vectorised_widths=False):
+    """
+    Compute the characteristic scales for the `cumulants` (pairs of names of
+    fields in `fields`) with the levels `z_` spread over a pool of `n_workers`
+    processes. The levels are written once to memory-mapped files (in shared
+    memory where available) which each worker opens, so that only the level
+    index and the resulting scales are passed between processes. Returns a
+    list (one per cumulant) of datasets in `zt` order
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='genesis_levels.', dir=_get_shared_dir())
+
+    try:
+        fields_info = dict([
+            (v_name, _write_levels_to_memmap(
+                da=da, z_=z_, z_batch_size=z_batch_size,
+                fn=os.path.join(tmp_dir, 'field{}.dat'.format(n))
+            ))
+            for (n, (v_name, da)) in enumerate(fields.items())
+        ])
+        mask_levels = _extract_mask_levels(mask, z=z_)
+        if mask_levels is not None:
+            mask_levels = mask_levels.load()
+
+        datasets = [None]*len(z_)
+
+        initargs = (fields_info, mask_levels, cumulants, sample_angle,
+                    width_method, single_precision, vectorised_widths)
+        pool = Pool(processes=n_workers, initializer=_init_level_worker,
+                    initargs=initargs)
+        try:
+            results = pool.imap_unordered(_scales_for_level, range(len(z_)))
+            for k, datasets_level in tqdm(results, total=len(z_)):
+                datasets[k] = datasets_level
+        finally:
+            pool.terminate()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return [
+        [datasets_level[n] for datasets_level in datasets]
+        for n in range(len(cumulants))
+    ]
+
+
+def get_height_variation_of_characteristic_scales(
+        v1_3d, z_max,
+        width_method=cumulant_analysis.WidthEstimationMethod.MASS_WEIGHTED,
+        v2_3d=None, z_min=0.0, mask=None, sample_angle=None,
+        batched=True, z_batch_size=Z_BATCH_SIZE, n_workers=1,
+        single_precision=False, vectorised_widths=False):
+    """
+    Compute the cumulant characteristic scales of `v1_3d` (and `v2_3d`) at
+    every level between `z_min` and `z_max`. With `batched=True` the cumulants
+    are computed for blocks of `z_batch_size` levels at once (all levels if
+    `z_batch_size` is None, which needs memory for all levels of the fields
+    and their spectra at once), otherwise each level is extracted and processed
+    separately. With `n_workers` > 1 the levels are spread over a pool of
+    processes instead. With `single_precision` the cumulants are computed in
+    float32/complex64 (see `cumulant.calc.calc_2nd_cumulant`) and with
+    `vectorised_widths` the widths are estimated with `cumulant.calc.calc_widths`
+    (see `cumulant.calc.scales_from_cumulant`)
+    """
+    z_ = v1_3d.zt[np.logical_and(v1_3d.zt > z_min, v1_3d.zt <= z_max)]
+
+    kwargs = dict(v1_3d=v1_3d, v2_3d=v2_3d, z_=z_, width_method=width_method,
+                  mask=mask, sample_angle=sample_angle,
+                  single_precision=single_precision,
+                  vectorised_widths=vectorised_widths)
+
+    if n_workers is not None and n_workers > 1:
+        if v2_3d is None:
+            fields = dict(v1=v1_3d)
+            cumulants = [('v1', 'v1')]
+        else:
+            fields = dict(v1=v1_3d, v2=v2_3d)
+            cumulants = [('v1', 'v2')]
+        datasets, = _get_height_variation_parallel(
+            fields=fields, cumulants=cumulants, z_=z_,
+            width_method=width_method, mask=mask, sample_angle=sample_angle,
+            n_workers=n_workers, z_batch_size=z_batch_size,
+            single_precision=single_precision,
+            vectorised_widths=vectorised_widths
+        )
+    elif batched:
+        datasets = _get_height_variation_batched(z_batch_size=z_batch_size,
+                                                 **kwargs)
+    else:
+        datasets = _get_height_variation_per_level(**kwargs)
+
     d = xr.concat(datasets, dim='zt')
 
     # since these were all computations for the same cumulant we can set just
@@ -148,8 +406,223 @@ def get_height_variation_of_characteristic_scales(
     return d
 
 
+def get_height_variation_of_characteristic_scales_for_cumulants(
+        fields, cumulants, z_max,
+        width_method=cumulant_analysis.WidthEstimationMethod.MASS_WEIGHTED,
+        z_min=0.0, mask=None, sample_angle=None,
+        z_batch_size=Z_BATCH_SIZE, n_workers=1, single_precision=False,
+        vectorised_widths=False):
+    """
+    Compute the cumulant characteristic scales for several cumulants at once,
+    with `fields` a dict of 3D fields by name and `cumulants` a list of pairs
+    of field names, e.g. `[('w', 'w'), ('w', 'qv')]`. Every field is only
+    Fourier transformed once per level and all the requested cumulants are
+    formed from these shared spectra. With `n_workers` > 1 the levels are
+    spread over a pool of processes, with `single_precision` the cumulants
+    are computed in float32/complex64 and with `vectorised_widths` the widths
+    are estimated with `cumulant.calc.calc_widths`. Returns one dataset indexed by
+    `cumulant`
+    """
+    v_ref = fields[cumulants[0][0]]
+    z_ = v_ref.zt[np.logical_and(v_ref.zt > z_min, v_ref.zt <= z_max)]
+
+    field_names = set([v_name for pair in cumulants for v_name in pair])
+
+    if n_workers is not None and n_workers > 1:
+        datasets = _get_height_variation_parallel(
+            fields=dict([(v_name, fields[v_name]) for v_name in field_names]),
+            cumulants=cumulants, z_=z_, width_method=width_method, mask=mask,
+            sample_angle=sample_angle, n_workers=n_workers,
+            z_batch_size=z_batch_size, single_precision=single_precision,
+            vectorised_widths=vectorised_widths
+        )
+    else:
+        datasets = _get_height_variation_serial(
+            fields=fields, field_names=field_names, cumulants=cumulants,
+            z_=z_, width_method=width_method, mask=mask,
+            sample_angle=sample_angle, z_batch_size=z_batch_size,
+            single_precision=single_precision,
+            vectorised_widths=vectorised_widths
+        )
+
+    param_datasets = []
+    for datasets_cumulant in datasets:
+        d = xr.concat(datasets_cumulant, dim='zt')
+        d['cumulant'] = d.cumulant.values[0]
+        param_datasets.append(d)
+
+    return xr.concat(param_datasets, dim='cumulant')
+
+
+def _get_height_variation_serial(fields, field_names, cumulants, z_,
+                                 width_method, mask=None, sample_angle=None,
+                                 z_batch_size=Z_BATCH_SIZE,
+                                 single_precision=False,
+                                 vectorised_widths=False):
+    datasets = [[] for _ in cumulants]
+
+    pbar = tqdm(total=len(z_))
+    for z_batch in _iterate_level_batches(z_, z_batch_size=z_batch_size):
+        fields_levels = dict([
+            (v_name, _extract_levels(fields[v_name], z=z_batch))
+            for v_name in field_names
+        ])
+        mask_levels = _extract_mask_levels(mask, z=z_batch)
+
+        cumulants_levels = cumulant_analysis.calc_2nd_cumulants(
+            fields=fields_levels, cumulants=cumulants, mask=mask_levels,
+            single_precision=single_precision
+        )
+
+        for n, C_vv in enumerate(cumulants_levels):
+            for k in range(len(z_batch)):
+                scales = cumulant_analysis.scales_from_cumulant(
+                    C_vv=C_vv.isel(zt=k), sample_angle=sample_angle,
+                    width_est_method=width_method,
+                    vectorised_widths=vectorised_widths
+                )
+                datasets[n].append(scales)
+        pbar.update(len(z_batch))
+    pbar.close()
+
+    return datasets
+
+
+def _scales_for_cumulant_levels(C_vv, width_method, sample_angle=None,
+                                vectorised_widths=False):
+    datasets = [
+        cumulant_analysis.scales_from_cumulant(
+            C_vv=C_vv.isel(zt=k), sample_angle=sample_angle,
+            width_est_method=width_method, vectorised_widths=vectorised_widths
+        )
+        for k in range(len(C_vv.zt))
+    ]
+
+    d = xr.concat(datasets, dim='zt')
+    d['cumulant'] = d.cumulant.values[0]
+
+    return d
+
+
+def get_time_mean_characteristic_scales_for_cumulants(
+        timesteps, cumulants, z_max,
+        width_method=cumulant_analysis.WidthEstimationMethod.MASS_WEIGHTED,
+        z_min=0.0, sample_angle=None, z_batch_size=Z_BATCH_SIZE,
+        single_precision=False, vectorised_widths=False):
+    """
+    Compute the cumulant characteristic scales from cumulants averaged over
+    many timesteps. `timesteps` should yield a tuple `(fields, mask)` for each
+    timestep (`mask` may be None), with `fields` a dict of 3D fields by name as
+    for `get_height_variation_of_characteristic_scales_for_cumulants`, so that
+    only one timestep needs to be loaded at a time. The cumulants (the inverse
+    transforms of the cross-spectra) are accumulated per level as the
+    timesteps are walked and the scales of the time-mean cumulants are
+    computed at the end.
+
+    Returns a dataset with the scales of the time-mean cumulants and the
+    scales for each timestep (as `{name}_per_timestep` along `time`) together
+    with the time-mean cumulants (indexed by `cumulant`)
+    """
+    C_sum = [[] for _ in cumulants]
+    z_ref = None
+    n_timesteps = 0
+    datasets_timesteps = []
+    times = []
+
+    for fields, mask in timesteps:
+        v_ref = fields[cumulants[0][0]]
+        z_ = v_ref.zt[np.logical_and(v_ref.zt > z_min, v_ref.zt <= z_max)]
+        field_names = set([v_name for pair in cumulants for v_name in pair])
+
+        if z_ref is None:
+            z_ref = z_
+        elif not (z_.shape == z_ref.shape and np.allclose(z_, z_ref)):
+            raise Exception("The heights of the levels changed between "
+                            "timesteps")
+
+        # the cumulants are accumulated and the scales for this timestep
+        # computed one batch of levels at a time, so that only the batch's
+        # cumulants are held alongside the time-mean
+        datasets_timestep = [[] for _ in cumulants]
+        z_batches = _iterate_level_batches(z_, z_batch_size=z_batch_size)
+        for i, z_batch in enumerate(z_batches):
+            fields_levels = dict([
+                (v_name, _extract_levels(fields[v_name], z=z_batch))
+                for v_name in field_names
+            ])
+            mask_levels = _extract_mask_levels(mask, z=z_batch)
+
+            cumulants_levels = cumulant_analysis.calc_2nd_cumulants(
+                fields=fields_levels, cumulants=cumulants, mask=mask_levels,
+                single_precision=single_precision
+            )
+            for n, C_vv in enumerate(cumulants_levels):
+                datasets_timestep[n].append(_scales_for_cumulant_levels(
+                    C_vv=C_vv, width_method=width_method,
+                    sample_angle=sample_angle,
+                    vectorised_widths=vectorised_widths
+                ))
+
+                if n_timesteps == 0:
+                    C_sum[n].append(C_vv)
+                    continue
+
+                C_vv_sum = C_sum[n][i]
+                if not C_vv.shape == C_vv_sum.shape:
+                    raise Exception("The shape of {} changed between "
+                                    "timesteps".format(C_vv.name))
+                C_vv_sum.values += C_vv.values
+
+        datasets_cumulants = []
+        for datasets_cumulant in datasets_timestep:
+            d = xr.concat(datasets_cumulant, dim='zt')
+            d['cumulant'] = d.cumulant.values[0]
+            datasets_cumulants.append(d)
+        datasets_timesteps.append(xr.concat(datasets_cumulants,
+                                            dim='cumulant'))
+
+        if 'time' in v_ref.coords:
+            times.append(v_ref.time.values.flatten()[0])
+        else:
+            times.append(n_timesteps)
+
+        n_timesteps += 1
+
+    if n_timesteps == 0:
+        raise Exception("No timesteps were provided")
+
+    C_mean = []
+    for C_vv_batches in C_sum:
+        C_vv = xr.concat(C_vv_batches, dim='zt')
+        C_vv_mean = C_vv/n_timesteps
+        C_vv_mean.attrs.update(C_vv.attrs)
+        C_vv_mean.name = C_vv.name
+        C_mean.append(C_vv_mean)
+
+    ds = xr.concat([
+        _scales_for_cumulant_levels(C_vv=C_vv, width_method=width_method,
+                                    sample_angle=sample_angle,
+                                    vectorised_widths=vectorised_widths)
+        for C_vv in C_mean
+    ], dim='cumulant')
+
+    ds_timesteps = xr.concat(datasets_timesteps, dim='time')
+    ds_timesteps['time'] = ('time', times)
+    for v in ds_timesteps.data_vars:
+        if v == 'cumulant':
+            continue
+        ds['{}_per_timestep'.format(v)] = ds_timesteps[v]
+
+    ds['cumulant_mean'] = xr.concat([
+        C_vv.reset_coords(drop=True) for C_vv in C_mean
+    ], dim='cumulant')
+    ds['n_timesteps'] = n_timesteps
+
+    return ds
+
+
 def process(base_name, variable_sets, z_min, z_max, width_method, mask=None,
-            sample_angle=None, debug=False):
+            sample_angle=None, debug=False, vectorised_widths=False):
     param_datasets = []
     for var_name_1, var_name_2 in variable_sets:
         v1_3d = get_data(base_name=base_name, var_name=var_name_1)
@@ -163,7 +636,8 @@ def process(base_name, variable_sets, z_min, z_max, width_method, mask=None,
                                                                    var_name_2))
         characteristic_scales = get_height_variation_of_characteristic_scales(
             v1_3d=v1_3d, v2_3d=v2_3d, z_max=z_max, z_min=z_min, mask=mask,
-            sample_angle=sample_angle, width_method=width_method
+            sample_angle=sample_angle, width_method=width_method,
+            vectorised_widths=vectorised_widths
         )
 
         param_datasets.append(characteristic_scales)
@@ -252,6 +726,9 @@ def run_default(debug=False):
     return process(PARAM_NAMES, VARIABLE_SETS, z_min=0., z_max=700.)
 
 FN_FORMAT = "{base_name}.cumulant_scales_profile.{v1}.{v2}.{mask}.nc"
+FN_FORMAT_SET = "{base_name}.cumulant_scales_profiles.{identifier}.{mask}.nc"
+FN_FORMAT_TIME_MEAN = ("{base_name}.cumulant_scales_profiles.tn{tn_start}_{tn_end}"
+                       ".{identifier}.{mask}.nc")
 
 if __name__ == "__main__":
     import argparse
@@ -278,6 +755,9 @@ if __name__ == "__main__":
         choices=list(cumulant_analysis.WidthEstimationMethod),
         default=cumulant_analysis.WidthEstimationMethod.MASS_WEIGHTED
     )
+    argparser.add_argument('--vectorised-widths', default=False,
+                           action='store_true',
+                           help='estimate widths with vectorised line sampling')
 
     args = argparser.parse_args()
 
@@ -341,7 +821,8 @@ if __name__ == "__main__":
                 mask=mask,
                 sample_angle=args.theta,
                 debug=args.debug,
-                width_method=args.width_method
+                width_method=args.width_method,
+                vectorised_widths=args.vectorised_widths
             )
 
     data.attrs['mask'] = mask_description
@@ -350,6 +831,9 @@ if __name__ == "__main__":
     out_filename = out_filename.replace('.nc', '.{}_width.nc'.format(
         args.width_method.name.lower()
     ))
+    if args.vectorised_widths:
+        data.attrs['width_estimation'] = 'vectorised'
+        out_filename = out_filename.replace('.nc', '.vectorised_widths.nc')
 
 
     if args.output_in_cwd:
@@ -58,7 +58,7 @@ def make_mask_from_objects_file(filename):
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(fn_objects, decode_times=False)
+    objects = label_store.open_labels(fn_objects, decode_times=False)
 
     mask = objects != 0
     mask.name = "{}_objects".format(objects.mask_name)
@@ -67,5 +67,8 @@ def make_mask_from_objects_file(filename):
     return mask
 
 from . import topology
+from . import object_index
+from . import label_store
+from . import component_tree
 from . import integrate, identify, filter
 from . import flux_contribution
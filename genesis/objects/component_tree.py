@@ -0,0 +1,162 @@
+"""
+Component tree of a scalar field for identifying objects at many thresholds
+at once. The objects at threshold `t` are the connected regions (with faces as
+neighbours) of `field > t`, and these regions are nested as the threshold is
+lowered. The nesting is captured by the maximum spanning forest of the graph
+connecting neighbouring voxels above the lowest threshold, with each
+connection weighted by the smaller of the two field values: for any threshold
+the connected regions are the same as those of the forest with only the
+connections above the threshold kept. The forest is built once (with a single
+sorted Kruskal pass in `scipy.sparse.csgraph`) after which the number of
+objects at any list of thresholds follows from counting voxels and
+connections, and the labelled objects at a threshold can be extracted when
+needed
+"""
+import os
+import tempfile
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+FN_SUFFIX = '.component_tree.npz'
+
+
+class ComponentTree(object):
+    def __init__(self, voxel_idx, values, edges, edge_values, shape, dims,
+                 threshold_min):
+        self.voxel_idx = voxel_idx
+        self.values = values
+        self.edges = edges
+        self.edge_values = edge_values
+        self.shape = tuple(shape)
+        self.dims = tuple(dims)
+        self.threshold_min = threshold_min
+
+    def _check_threshold(self, threshold):
+        if np.any(np.asarray(threshold) < self.threshold_min):
+            raise Exception("Component tree was built for thresholds above {},"
+                            " can't use {}".format(self.threshold_min,
+                                                   threshold))
+
+    def count_objects(self, thresholds):
+        """
+        Number of objects for each of `thresholds`, this is the number of
+        voxels above the threshold minus the number of forest connections
+        joining them
+        """
+        self._check_threshold(thresholds)
+        thresholds = np.asarray(thresholds)
+        n_voxels = len(self.values) - np.searchsorted(
+            np.sort(self.values), thresholds, side='right'
+        )
+        n_edges = len(self.edge_values) - np.searchsorted(
+            np.sort(self.edge_values), thresholds, side='right'
+        )
+        return n_voxels - n_edges
+
+    def labels(self, threshold):
+        """
+        Labelled objects at `threshold`, numbered in the order the objects'
+        first voxels are found in the domain (as `scipy.ndimage.label`)
+        """
+        self._check_threshold(threshold)
+        nodes = np.flatnonzero(self.values > threshold)
+        edges = self.edges[:,self.edge_values > threshold]
+        # the nodes are ordered by voxel index and the edges only join nodes
+        # above the threshold
+        edges = np.searchsorted(nodes, edges)
+
+        n = len(nodes)
+        graph = scipy.sparse.coo_matrix(
+            (np.ones(edges.shape[1]), (edges[0], edges[1])), shape=(n, n)
+        )
+        _, node_labels = scipy.sparse.csgraph.connected_components(
+            graph, directed=False
+        )
+
+        labels = np.zeros(int(np.prod(self.shape)), dtype=np.uint32)
+        labels[self.voxel_idx[nodes]] = node_labels + 1
+        return labels.reshape(self.shape)
+
+    def save(self, fn):
+        """
+        Store the tree in `fn`. The file is replaced atomically so that
+        several processes can share the same tree file
+        """
+        p_dir = os.path.dirname(os.path.abspath(fn))
+        fh, fn_tmp = tempfile.mkstemp(dir=p_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fh, 'wb') as fh:
+                np.savez(fh, voxel_idx=self.voxel_idx, values=self.values,
+                         edges=self.edges, edge_values=self.edge_values,
+                         shape=np.array(self.shape), dims=np.array(self.dims),
+                         threshold_min=self.threshold_min)
+            os.replace(fn_tmp, fn)
+        except:
+            if os.path.exists(fn_tmp):
+                os.remove(fn_tmp)
+            raise
+
+    @staticmethod
+    def load(fn):
+        with np.load(fn) as f:
+            return ComponentTree(voxel_idx=f['voxel_idx'],
+                                 values=f['values'], edges=f['edges'],
+                                 edge_values=f['edge_values'],
+                                 shape=f['shape'],
+                                 dims=[str(d) for d in f['dims']],
+                                 threshold_min=float(f['threshold_min']))
+
+
+def build_component_tree(da_scalar, threshold_min):
+    """
+    Build the component tree of `da_scalar` for thresholds above
+    `threshold_min`
+    """
+    da_scalar = da_scalar.squeeze()
+    shape = da_scalar.shape
+    field = np.asarray(da_scalar.values).ravel()
+
+    voxel_idx = np.flatnonzero(field > threshold_min)
+    values = field[voxel_idx]
+
+    # connections between neighbouring voxels which are both above the
+    # lowest threshold
+    edges = []
+    for ax, n in enumerate(shape):
+        stride = int(np.prod(shape[ax+1:]))
+        has_next = (voxel_idx // stride) % n < n - 1
+        idx_a = np.flatnonzero(has_next)
+        idx_b = np.searchsorted(voxel_idx, voxel_idx[idx_a] + stride)
+        idx_b[idx_b == len(voxel_idx)] = 0
+        is_above = voxel_idx[idx_b] == voxel_idx[idx_a] + stride
+        edges.append(np.array([idx_a[is_above], idx_b[is_above]]))
+    edges = np.concatenate(edges, axis=1)
+    edge_values = np.minimum(values[edges[0]], values[edges[1]])
+
+    # maximum spanning forest, found as the minimum spanning forest of the
+    # reversed rank of the connection values (ranks start at one as zeros are
+    # taken as missing connections)
+    _, rank = np.unique(edge_values, return_inverse=True)
+    if len(rank) > 0:
+        weights = (rank.max() + 1 - rank).astype(np.float64)
+    else:
+        weights = np.zeros(0)
+    n = len(voxel_idx)
+    graph = scipy.sparse.coo_matrix((weights, (edges[0], edges[1])),
+                                    shape=(n, n))
+    forest = scipy.sparse.csgraph.minimum_spanning_tree(graph).tocoo()
+    forest_edges = np.array([forest.row, forest.col]).astype(np.int64)
+
+    return ComponentTree(
+        voxel_idx=voxel_idx, values=values, edges=forest_edges,
+        edge_values=np.minimum(values[forest_edges[0]],
+                               values[forest_edges[1]]),
+        shape=shape, dims=da_scalar.dims, threshold_min=threshold_min,
+    )
+
+
+def make_tree_filename(fn_scalar, threshold_min):
+    return "{}.gt{}{}".format(os.path.splitext(fn_scalar)[0], threshold_min,
+                              FN_SUFFIX)
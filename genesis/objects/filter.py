@@ -7,7 +7,6 @@ import warnings
 
 import xarray as xr
 import numpy as np
-import tqdm
 
 import genesis.objects
 
@@ -111,36 +110,90 @@ def filter_objects_by_tracking(objects, base_name, dt_pad):
 
     id3d_tracked_from_projected = filter_nans(np.unique(projected_labels_tracked))
 
-    objects_filtered = np.zeros_like(objects)
-
     print("Picking out objects which were tracked...")
-    for object_id in tqdm.tqdm(id3d_tracked_from_projected):
-        objects_filtered += objects.where(objects == object_id, other=0)
+    table = make_filter_table(id3d_tracked_from_projected,
+                              max_id=get_max_object_id(objects))
 
-    return objects_filtered
+    return relabel_objects(objects, table)
 
 
-def filter_objects_by_property(objects, da_property, op, value):
+def make_filter_table(object_ids, max_id, table=None):
+    """
+    Make a lookup-table over the object ids `0...max_id` which keeps the
+    objects in `object_ids` and maps all others to zero. If an existing
+    `table` is given the objects it has already removed stay removed, so that
+    a chain of filters combines into a single table
+    """
+    if table is None:
+        table = np.arange(max_id+1)
+    else:
+        table = table.copy()
+
+    object_ids = np.asarray(object_ids)
+    object_ids = object_ids[~np.isnan(object_ids)].astype(np.int64)
+    table[~np.isin(np.arange(len(table)), object_ids)] = 0
+    return table
+
+
+def relabel_objects(objects, table):
+    """
+    Relabel `objects` with the lookup-table `table` (see `make_filter_table`)
+    in a single pass over the labels
+    """
+    labels = objects.values
+    if labels.dtype.kind == 'f':
+        labels = np.nan_to_num(labels)
+    labels = labels.astype(np.int64)
+
+    objects_relabelled = objects.copy(data=table[labels].astype(objects.dtype))
+    # the relabelled objects no longer match the index stored for the source
+    # file
+    objects_relabelled.encoding.pop('source', None)
+    return objects_relabelled
+
+
+def get_max_object_id(objects):
+    return int(np.nan_to_num(objects.max().values))
+
+
+def find_objects_by_property(da_property, op, value):
+    """
+    Ids of the objects for which `da_property` is `op` (`less_than`,
+    `greater_than` or `equals`) `value`
+    """
     N_objects = len(da_property.object_id)
 
     op_fn = getattr(np, op.replace('_than', ''))
 
     ids_filtered = da_property.where(op_fn(da_property, value), drop=True).object_id
 
-    objects_filtered = np.zeros_like(objects)
-
     print("Picking out objects for which {} is {} {} ({}/{}~{}%)...".format(
         da_property.name,
         op.replace('_', ' '), value, len(ids_filtered), N_objects,
         int(float(len(ids_filtered))/float(N_objects)*100.),
         ))
 
-    for object_id in tqdm.tqdm(ids_filtered):
-        objects_filtered += objects.where(objects == object_id, other=0)
+    return ids_filtered.values
+
+
+def make_filtered_mask_name(mask_name, da_property, op, value):
+    return "{}.filtered_by.{}_{}_{}".format(
+        mask_name, da_property.name, op, value
+    )
+
+
+def filter_objects_by_property(objects, da_property, op, value):
+    ids_filtered = find_objects_by_property(da_property=da_property, op=op,
+                                            value=value)
+
+    table = make_filter_table(ids_filtered,
+                              max_id=get_max_object_id(objects))
+    objects_filtered = relabel_objects(objects, table)
 
     objects_filtered.attrs['input_name'] = objects.name
-    objects_filtered.attrs['mask_name'] = "{}.filtered_by.{}_{}_{}".format(
-        objects.mask_name, da_property.name, op, value
+    objects_filtered.attrs['mask_name'] = make_filtered_mask_name(
+        mask_name=objects.mask_name, da_property=da_property, op=op,
+        value=value
     )
 
     return objects_filtered
@@ -180,7 +233,7 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(fn_objects, decode_times=False)
+    objects = genesis.objects.label_store.open_labels(fn_objects, decode_times=False)
 
     if args.subparser_name == "mask":
         fn_mask = "{}.{}.mask.nc".format(base_name, args.mask_name)
@@ -247,5 +300,5 @@ if __name__ == "__main__":
     else:
         raise NotImplementedError
 
-    ds.to_netcdf(out_filename)
+    genesis.objects.label_store.write_labels(ds, out_filename)
     print("Wrote output to `{}`".format(out_filename))
@@ -3,15 +3,24 @@ Utilities for labelling 3D objects from a mask
 """
 import os
 import warnings
+import itertools
+from multiprocessing import Pool
 
 import xarray as xr
 import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 
 import cloud_identification
 from ..utils import find_grid_spacing
 
 OUT_FILENAME_FORMAT = "{base_name}.objects.{objects_name}.nc"
 
+# used in place of the splitting scalar name when objects are just the
+# connected regions of the mask
+NO_SPLITTING = 'none'
+
 def make_objects_name(mask_name, splitting_var):
     return "{mask_name}.split_on.{splitting_var}".format(**locals())
 
@@ -41,22 +50,143 @@ def _label_objects_wrapper(mask, splitting_scalar, remove_at_edge=False):
 
     return object_labels
 
-def label_objects(mask, splitting_scalar):
+def _iterate_tiles(shape, chunks):
+    ranges = [range(0, n, c) for (n, c) in zip(shape, chunks)]
+    for starts in itertools.product(*ranges):
+        yield tuple([
+            slice(i, min(i + c, n)) for (i, c, n) in zip(starts, chunks, shape)
+        ])
+
+
+def _label_tile(mask_tile):
+    labels, n_labels = scipy.ndimage.label(mask_tile)
+    # labels are numbered in the order they are first found in the tile, so
+    # the first voxel of each label is where the running maximum increases
+    idx = np.flatnonzero(labels)
+    labels_max = np.maximum.accumulate(labels.ravel()[idx])
+    is_first = np.ones(len(idx), dtype=bool)
+    is_first[1:] = labels_max[1:] > labels_max[:-1]
+    return labels, n_labels, idx[is_first]
+
+
+def label_connected_chunked(mask, chunks, n_workers=1, out=None):
+    """
+    Label the connected regions of `mask` (with faces as neighbours, like
+    `scipy.ndimage.label`) by labelling tiles of the domain separately (in
+    parallel with `n_workers` processes) and then merging the labels which
+    touch across the tile faces. `chunks` gives the tile size along each
+    dimension (for example `dict(xt=512, yt=512)`), dimensions not included
+    aren't split. `mask` can be backed by a file or dask, only the tiles being
+    labelled are read into memory. The labels are numbered in the same order
+    as labelling the whole domain at once. The labels are written to `out`
+    if given (for example a `np.memmap`)
+    """
+    shape = mask.shape
+    tile_size = [chunks.get(d, n) for (d, n) in zip(mask.dims, shape)]
+    tiles = list(_iterate_tiles(shape, tile_size))
+
+    def _read_mask_tiles():
+        for tile in tiles:
+            yield np.asarray(mask[tile].values, dtype=bool)
+
+    if out is None:
+        object_labels = np.zeros(shape, dtype=np.uint32)
+    else:
+        object_labels = out
+    first_voxel = []
+    n_total = 0
+
+    pool = Pool(n_workers) if n_workers > 1 else None
+    try:
+        if pool is not None:
+            results = pool.imap(_label_tile, _read_mask_tiles())
+        else:
+            results = map(_label_tile, _read_mask_tiles())
+
+        # give each tile's labels a unique range and record where the first
+        # voxel of each label is in the whole domain
+        for tile, (labels, n_labels, idx_first) in zip(tiles, results):
+            object_labels[tile] = np.where(labels > 0, labels + n_total, 0)
+            pos = np.unravel_index(idx_first, labels.shape)
+            pos = [p + t.start for (p, t) in zip(pos, tile)]
+            first_voxel.append(np.ravel_multi_index(pos, shape))
+            n_total += n_labels
+    finally:
+        if pool is not None:
+            pool.close()
+
+    # pairs of labels which touch across the tile faces
+    pairs = [np.zeros((2, 0), dtype=np.int64)]
+    for ax, c in enumerate(tile_size):
+        for i in range(c, shape[ax], c):
+            l_a = object_labels.take(i - 1, axis=ax)
+            l_b = object_labels.take(i, axis=ax)
+            m = np.logical_and(l_a > 0, l_b > 0)
+            pairs.append(np.unique(np.array([l_a[m], l_b[m]]), axis=1))
+    pairs = np.concatenate(pairs, axis=1)
+
+    # merge the touching labels and number the merged labels by their first
+    # voxel in the domain
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(pairs.shape[1]), (pairs[0], pairs[1])),
+        shape=(n_total+1, n_total+1)
+    )
+    n_merged, merged = scipy.sparse.csgraph.connected_components(
+        graph, directed=False
+    )
+    merged = merged[1:]
+    merged_first = np.full(n_merged, np.iinfo(np.int64).max)
+    np.minimum.at(merged_first, merged,
+                  np.concatenate([np.zeros(0, dtype=np.int64)] + first_voxel))
+    new_ids = np.zeros(n_merged, dtype=np.uint32)
+    new_ids[np.argsort(merged_first, kind='stable')] = np.arange(1, n_merged+1)
+
+    table = np.zeros(n_total+1, dtype=object_labels.dtype)
+    table[1:] = new_ids[merged]
+    for tile in tiles:
+        object_labels[tile] = table[object_labels[tile]]
+
+    return object_labels
+
+
+def label_objects(mask, splitting_scalar, chunks=None, n_workers=1,
+                  out=None):
+    """
+    Label the objects in `mask` by splitting on the local maxima of
+    `splitting_scalar`. Without a splitting scalar the objects are the
+    connected regions of the mask, which can be labelled in tiles (see
+    `label_connected_chunked`) for domains too large to label at once, with
+    the labels written to `out` if given
+    """
     dx = find_grid_spacing(mask)
 
     if splitting_scalar is not None:
+        if chunks is not None:
+            raise NotImplementedError("Splitting objects on a scalar field"
+                                      " can't be done in chunks, only"
+                                      " labelling connected regions can")
         mask = mask.sel(zt=splitting_scalar.zt).squeeze()
-
-    object_labels = _label_objects_wrapper(mask=mask, splitting_scalar=splitting_scalar)
+        object_labels = _label_objects_wrapper(
+            mask=mask, splitting_scalar=splitting_scalar
+        )
+        splitting_var = splitting_scalar.name
+    else:
+        if chunks is not None:
+            object_labels = label_connected_chunked(mask=mask, chunks=chunks,
+                                                    n_workers=n_workers,
+                                                    out=out)
+        else:
+            object_labels, _ = scipy.ndimage.label(mask.values)
+        splitting_var = NO_SPLITTING
 
     da = xr.DataArray(data=object_labels, coords=mask.coords, dims=mask.dims,
                       name="object_labels")
 
     da.name = make_objects_name(
-        mask_name=mask.name, splitting_var=splitting_scalar.name
+        mask_name=mask.name, splitting_var=splitting_var
     )
     da.attrs['mask_name'] = mask.name
-    da.attrs['splitting_scalar'] = splitting_scalar.name
+    da.attrs['splitting_scalar'] = splitting_var
 
     return da
 
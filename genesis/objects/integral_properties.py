@@ -1,21 +1,25 @@
 import numpy as np
 import xarray as xr
 
-import dask_image.ndmeasure
+from . import object_index as objects_index
 
 VAR_MAPPINGS = dict(
     length_m="minkowski",
     width_m="minkowski",
     thickness_m="minkowski",
-    num_cells="minkowski",
     volume="minkowski",
     filamentarity="minkowski",
     planarity="minkowski",
-    theta="com_incline_and_orientation_angle",
-    phi="com_incline_and_orientation_angle",
-    x_c="centroid",
-    y_c="centroid",
-    z_c="centroid",
+    theta="com_angles",
+    phi="com_angles",
+    num_cells="extents",
+    x_c="extents",
+    y_c="extents",
+    z_c="extents",
+    z_max="extents",
+    z_min="extents",
+    z_proj_length="extents",
+    xy_proj_length="extents",
 )
 
 def calc_com_incline_and_orientation_angle(da_mask, return_centerline_pts=False):
@@ -29,19 +33,19 @@ def calc_com_incline_and_orientation_angle(da_mask, return_centerline_pts=False)
     else:
         m = da_mask
 
-    # need to center coordinates on "center of mass" (assuming constant density)
+    # compute mean xy-position at every height z, this is the effective
+    # centre-of-mass (assuming constant density)
     if len(da_mask.x.shape) == 3:
-        x_3d = da_mask.x
-        y_3d = da_mask.y
-        z_3d = da_mask.z
+        kws = dict(dtype='float64', dim=('x', 'y'))
+        x_c = da_mask.x.where(m).mean(**kws)  # other=nan so that these get excluded from mean calculation
+        y_c = da_mask.y.where(m).mean(**kws)
     else:
-        x_3d, y_3d, z_3d = xr.broadcast(da_mask.x, da_mask.y, da_mask.z)
-
-    # compute mean xy-position at every height z, this is the effective
-    # centre-of-mass
-    kws = dict(dtype='float64', dim=('x', 'y'))
-    x_c = x_3d.where(m).mean(**kws)  # other=nan so that these get excluded from mean calculation
-    y_c = y_3d.where(m).mean(**kws)
+        # weight the 1D coordinates by the number of cells in each column so
+        # that the coordinates don't have to be broadcast to 3D
+        n_cells = m.sum(dim=('x', 'y'))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_c = (da_mask.x*m.sum(dim='y')).sum(dim='x')/n_cells
+            y_c = (da_mask.y*m.sum(dim='x')).sum(dim='y')/n_cells
 
     try:
         dx = np.gradient(x_c)
@@ -75,179 +79,349 @@ def calc_com_incline_and_orientation_angle(da_mask, return_centerline_pts=False)
         return ds
 
 
-def calc_xy_proj_length(da_mask):
+def _get_object_mask(da_mask):
     if np.any(da_mask.isnull()):
-        m = ~da_mask.isnull()
+        return ~da_mask.isnull()
     else:
-        m = da_mask
+        return da_mask
 
-    if len(da_mask.x.shape) == 3:
-        x_3d = da_mask.x
-        y_3d = da_mask.y
-    else:
-        x_3d, y_3d, _ = xr.broadcast(da_mask.x, da_mask.y, da_mask.z)
 
-    x_min, x_max = x_3d.where(m).min(), x_3d.where(m).max()
-    y_min, y_max = y_3d.where(m).min(), y_3d.where(m).max()
+def _occupied_coord(m, dim):
+    """
+    Values of coordinate `dim` at which the object mask `m` has any cells
+    """
+    if len(m[dim].shape) == len(m.shape):
+        return m[dim].where(m)
+    other_dims = [d for d in m.dims if d != dim]
+    return m[dim].where(m.any(dim=other_dims), drop=True)
 
-    lx = x_max - x_min
-    ly = y_max - y_min
+
+def calc_xy_proj_length(da_mask):
+    m = _get_object_mask(da_mask)
+
+    x_occ, y_occ = _occupied_coord(m, 'x'), _occupied_coord(m, 'y')
+
+    lx = x_occ.max() - x_occ.min()
+    ly = y_occ.max() - y_occ.min()
 
     l = np.sqrt(lx**2. + ly**2.)
     l.attrs['long_name'] = 'xy-projected length'
-    l.attrs['units'] = x_3d.units
+    l.attrs['units'] = da_mask.x.units
     return l
 
 
 def calc_z_proj_length(da_mask):
-    if np.any(da_mask.isnull()):
-        m = ~da_mask.isnull()
-    else:
-        m = da_mask
+    m = _get_object_mask(da_mask)
 
-    if len(da_mask.x.shape) == 3:
-        x_3d = da_mask.x
-        y_3d = da_mask.y
-    else:
-        _, _, z_3d = xr.broadcast(da_mask.x, da_mask.y, da_mask.z)
+    z_occ = _occupied_coord(m, 'z')
 
-    z_min, z_max = z_3d.where(m).min(), z_3d.where(m).max()
-
-    l = z_max - z_min
+    l = z_occ.max() - z_occ.min()
     l.attrs['long_name'] = 'z-projected length'
-    l.attrs['units'] = z_3d.units
+    l.attrs['units'] = da_mask.z.units
     return l
 
 def calc_z_max(da_mask):
-    if len(da_mask.x.shape) == 3:
-        x_3d = da_mask.x
-        y_3d = da_mask.y
-    else:
-        _, _, z_3d = xr.broadcast(da_mask.x, da_mask.y, da_mask.z)
+    m = _get_object_mask(da_mask)
 
-    z_max = z_3d.where(m).max()
+    z_max = _occupied_coord(m, 'z').max()
     z_max.attrs['long_name'] = 'max height'
-    z_max.attrs['units'] = z_3d.units
+    z_max.attrs['units'] = da_mask.z.units
     return z_max
 
 
-def calc_z_max__dask(da_objs):
-    if len(da_objs.x.shape) == 3:
-        x_3d = da_objs.x
-        y_3d = da_objs.y
+def _get_object_index(da_objs, object_index):
+    if object_index is None:
+        object_index = objects_index.get_object_index(da_objs)
+    return object_index
+
+
+def _coord_values(da_objs, object_index, dim):
+    """
+    Value of coordinate `dim` for every voxel of every object in the order of
+    `object_index`
+    """
+    da_objs = da_objs.squeeze()
+    coord = da_objs[dim]
+    if len(coord.shape) == len(da_objs.shape):
+        return object_index.values(coord)
     else:
-        _, _, z_3d = xr.broadcast(*[da_objs[d] for d in da_objs.dims])
+        return coord.values[object_index.axis_index(da_objs.dims.index(dim))]
 
-    assert z_3d.shape == da_objs.shape
-    assert z_3d.dims == da_objs.dims
 
-    idx = np.unique(da_objs)[1:]
-    z_max_vals = dask_image.ndmeasure.maximum(z_3d, da_objs, idx).compute()
+def _coord_extremes(da_objs, object_index, dim):
+    """
+    Minimum and maximum of coordinate `dim` over every object. For 1D
+    coordinates the extremes of the integer index along `dim` are found first
+    and only these are looked up in the coordinate
+    """
+    da_objs = da_objs.squeeze()
+    coord = da_objs[dim]
+    if len(coord.shape) == len(da_objs.shape):
+        v = object_index.values(coord)
+        return object_index.reduce(v, 'minimum'), object_index.reduce(v, 'maximum')
 
-    z_max = xr.DataArray(data=z_max_vals, coords=[idx], dims=['object_id'])
-    z_max.attrs['long_name'] = 'max height'
-    z_max.attrs['units'] = z_3d.units
-    return z_max
+    k = object_index.axis_index(da_objs.dims.index(dim))
+    v_a = coord.values[object_index.reduce(k, 'minimum')]
+    v_b = coord.values[object_index.reduce(k, 'maximum')]
+    # the coordinate may be decreasing
+    return np.minimum(v_a, v_b), np.maximum(v_a, v_b)
 
-def calc_z_proj_length__dask(da_objs):
-    if len(da_objs.x.shape) == 3:
-        x_3d = da_objs.x
-        y_3d = da_objs.y
-    else:
-        _, _, z_3d = xr.broadcast(*[da_objs[d] for d in da_objs.dims])
 
-    assert z_3d.shape == da_objs.shape
-    assert z_3d.dims == da_objs.dims
+def _make_per_object_da(vals, object_index, long_name, units, name=None):
+    da = xr.DataArray(data=vals, coords=[object_index.object_ids],
+                      dims=['object_id'], name=name)
+    da.attrs['long_name'] = long_name
+    da.attrs['units'] = units
+    return da
 
-    idx = np.unique(da_objs)[1:]
-    z_max_vals = dask_image.ndmeasure.maximum(z_3d, da_objs, idx).compute()
-    z_min_vals = dask_image.ndmeasure.minimum(z_3d, da_objs, idx).compute()
 
-    l_vals = z_max_vals - z_min_vals
+def calc_z_max__dask(da_objs, object_index=None):
+    object_index = _get_object_index(da_objs, object_index)
 
-    l = xr.DataArray(data=l_vals, coords=[idx], dims=['object_id'])
-    l.attrs['long_name'] = 'z-projected length'
-    l.attrs['units'] = z_3d.units
-    return l
+    _, z_max_vals = _coord_extremes(da_objs, object_index, 'z')
 
-def calc_z_min__dask(da_objs):
-    if len(da_objs.x.shape) == 3:
-        x_3d = da_objs.x
-        y_3d = da_objs.y
-    else:
-        _, _, z_3d = xr.broadcast(*[da_objs[d] for d in da_objs.dims])
+    return _make_per_object_da(z_max_vals, object_index,
+                               long_name='max height', units=da_objs.z.units)
 
-    idx = np.unique(da_objs)[1:]
-    z_min_vals = dask_image.ndmeasure.minimum(z_3d, da_objs, idx).compute()
+def calc_z_proj_length__dask(da_objs, object_index=None):
+    object_index = _get_object_index(da_objs, object_index)
 
-    assert z_3d.shape == da_objs.shape
-    assert z_3d.dims == da_objs.dims
+    z_min_vals, z_max_vals = _coord_extremes(da_objs, object_index, 'z')
 
-    z_min = xr.DataArray(data=z_min_vals, coords=[idx], dims=['object_id'])
-    z_min.attrs['long_name'] = 'min height'
-    z_min.attrs['units'] = z_3d.units
-    return z_min
+    l_vals = z_max_vals - z_min_vals
 
-def calc_centroid__dask(da_objs):
-    if len(da_objs.x.shape) == 3:
-        x_3d = da_objs.x
-        y_3d = da_objs.y
-    else:
-        x_3d, y_3d, z_3d = xr.broadcast(da_objs.z, da_objs.y, da_objs.x)
+    return _make_per_object_da(l_vals, object_index,
+                               long_name='z-projected length',
+                               units=da_objs.z.units)
 
-    assert z_3d.shape == da_objs.shape
-    assert z_3d.dims == da_objs.dims
+def calc_z_min__dask(da_objs, object_index=None):
+    object_index = _get_object_index(da_objs, object_index)
 
-    idx = np.unique(da_objs)[1:]
-    x_c_vals = dask_image.ndmeasure.mean(x_3d, da_objs, idx)
-    y_c_vals = dask_image.ndmeasure.mean(y_3d, da_objs, idx)
-    z_c_vals = dask_image.ndmeasure.mean(z_3d, da_objs, idx)
+    z_min_vals, _ = _coord_extremes(da_objs, object_index, 'z')
 
-    x_c = xr.DataArray(data=x_c_vals, coords=[idx], dims=['object_id'])
-    x_c.attrs['long_name'] = 'centroid x-position'
-    x_c.attrs['units'] = x_3d.units
-    x_c.name = "x_c"
+    return _make_per_object_da(z_min_vals, object_index,
+                               long_name='min height', units=da_objs.z.units)
 
-    y_c = xr.DataArray(data=y_c_vals, coords=[idx], dims=['object_id'])
-    y_c.attrs['long_name'] = 'centroid y-position'
-    y_c.attrs['units'] = y_3d.units
-    y_c.name = "y_c"
+def calc_centroid__dask(da_objs, object_index=None):
+    object_index = _get_object_index(da_objs, object_index)
 
-    z_c = xr.DataArray(data=z_c_vals, coords=[idx], dims=['object_id'])
-    z_c.attrs['long_name'] = 'centroid z-position'
-    z_c.attrs['units'] = z_3d.units
-    z_c.name = "z_c"
+    das = []
+    for d in ['x', 'y', 'z']:
+        v = _coord_values(da_objs, object_index, d)
+        v_c_vals = object_index.reduce(v, 'mean')
+        das.append(_make_per_object_da(
+            v_c_vals, object_index, name='{}_c'.format(d),
+            long_name='centroid {}-position'.format(d),
+            units=da_objs[d].units
+        ))
 
-    ds = xr.merge([x_c, y_c, z_c])
+    ds = xr.merge(das)
 
     return ds
 
-def calc_xy_proj_length__dask(da_objs):
-    x_3d, y_3d, _ = xr.broadcast(da_objs.x, da_objs.y, da_objs.z)
+def calc_xy_proj_length__dask(da_objs, object_index=None):
+    object_index = _get_object_index(da_objs, object_index)
 
-    idx = np.unique(da_objs)[1:]
-    x_min = dask_image.ndmeasure.minimum(x_3d, da_objs, idx)
-    x_max = dask_image.ndmeasure.maximum(x_3d, da_objs, idx)
-    y_min = dask_image.ndmeasure.minimum(y_3d, da_objs, idx)
-    y_max = dask_image.ndmeasure.maximum(y_3d, da_objs, idx)
+    x_min, x_max = _coord_extremes(da_objs, object_index, 'x')
+    y_min, y_max = _coord_extremes(da_objs, object_index, 'y')
 
     lx = x_max - x_min
     ly = y_max - y_min
 
     l = np.sqrt(lx**2. + ly**2.)
-    da_l = xr.DataArray(data=l, coords=[idx], dims=['object_id'])
-    da_l.attrs['long_name'] = 'xy-projected length'
-    da_l.attrs['units'] = x_3d.units
-    return da_l
-
-def calc_vertical_flux__dask(da_objs, w, scalar):
-    flux_per_cell = w*scalar
-
-    idx = np.unique(da_objs)[1:]
-    qflux_per_obj
-    obj_flux = dask_image.ndmeasure.sum(flux_per_cell, da_objs, idx).compute()
-
-    obj_flux = xr.DataArray(data=obj_flux_vals, coords=[idx], dims=['object_id'])
-    obj_flux.attrs['long_name'] = 'min height'
-    obj_flux.attrs['units'] = "{} {}".format(scalar.units, w.units)
-    return obj_flux
+    return _make_per_object_da(l, object_index,
+                               long_name='xy-projected length',
+                               units=da_objs.x.units)
+
+def _mean_coord(coord, k, k_mean, object_index):
+    """
+    Mean of the 1D coordinate `coord` over every object given the index along
+    the coordinate for every sorted voxel (`k`) and the per-object mean of
+    these indices (`k_mean`). On a uniform grid the mean index maps linearly
+    onto the coordinate, otherwise the coordinate is averaged directly
+    """
+    c = coord.values
+    if len(c) == 1:
+        return np.full(len(k_mean), c[0], dtype=np.float64)
+
+    dc = np.diff(c)
+    if np.allclose(dc, dc[0]):
+        return c[0] + dc[0]*k_mean
+    else:
+        return object_index.reduce(c[k], 'mean')
+
+
+def calc_extents__dask(da_objs, object_index=None):
+    """
+    Compute the bounding box and extent properties of all objects in one go:
+    the per-object minimum, maximum and sum of the index along each axis are
+    found with a single reduction over the sorted voxels of the object index
+    and `z_max`, `z_min`, `z_proj_length`, `xy_proj_length`, the centroid
+    (`x_c`, `y_c`, `z_c`) and `num_cells` are derived from these
+    """
+    object_index = _get_object_index(da_objs, object_index)
+
+    da_objs_ = da_objs.squeeze()
+    dims = ['x', 'y', 'z']
+
+    for d in dims:
+        if len(da_objs_[d].shape) == len(da_objs_.shape):
+            raise NotImplementedError("Extents can only be computed with 1D "
+                                      "coordinates")
+
+    axes = [da_objs_.dims.index(d) for d in dims]
+    K = np.stack([object_index.axis_index(ax) for ax in axes], axis=1)
+
+    num_cells = object_index.counts
+    if len(object_index) > 0:
+        starts = object_index.offsets[:-1]
+        K_min = np.minimum.reduceat(K, starts, axis=0)
+        K_max = np.maximum.reduceat(K, starts, axis=0)
+        K_mean = np.add.reduceat(K, starts, axis=0)/num_cells[:, None]
+    else:
+        K_min = K_max = np.zeros((0, 3), dtype=int)
+        K_mean = np.zeros((0, 3))
+
+    v_min, v_max, v_c = {}, {}, {}
+    for n, d in enumerate(dims):
+        coord = da_objs_[d]
+        v_a, v_b = coord.values[K_min[:,n]], coord.values[K_max[:,n]]
+        # the coordinate may be decreasing
+        v_min[d], v_max[d] = np.minimum(v_a, v_b), np.maximum(v_a, v_b)
+        v_c[d] = _mean_coord(coord, k=K[:,n], k_mean=K_mean[:,n],
+                             object_index=object_index)
+
+    units = dict([(d, da_objs_[d].units) for d in dims])
+
+    das = [
+        _make_per_object_da(v_max['z'], object_index, name='z_max',
+                            long_name='max height', units=units['z']),
+        _make_per_object_da(v_min['z'], object_index, name='z_min',
+                            long_name='min height', units=units['z']),
+        _make_per_object_da(v_max['z'] - v_min['z'], object_index,
+                            name='z_proj_length',
+                            long_name='z-projected length', units=units['z']),
+        _make_per_object_da(np.sqrt((v_max['x'] - v_min['x'])**2.
+                                    + (v_max['y'] - v_min['y'])**2.),
+                            object_index, name='xy_proj_length',
+                            long_name='xy-projected length', units=units['x']),
+        _make_per_object_da(num_cells, object_index, name='num_cells',
+                            long_name='number of cells', units='1'),
+    ]
+    for d in dims:
+        das.append(_make_per_object_da(
+            v_c[d], object_index, name='{}_c'.format(d),
+            long_name='centroid {}-position'.format(d), units=units[d]
+        ))
+
+    return xr.merge(das)
+
+
+def _gradient_in_range(f, k_min, k_max):
+    """
+    Gradient (as with `np.gradient`, i.e. central differences in the interior
+    and one-sided differences at the ends) along the last axis of `f` between
+    `k_min` and `k_max` (inclusive) for every row of `f`. nan outside the range
+    """
+    k = np.arange(f.shape[1])[None, :]
+    k_min, k_max = k_min[:, None], k_max[:, None]
+
+    f_pad = np.pad(f, ((0, 0), (1, 1)), mode='constant',
+                   constant_values=np.nan)
+    f_prev, f_next = f_pad[:, :-2], f_pad[:, 2:]
+
+    grad = 0.5*(f_next - f_prev)
+    grad = np.where(k == k_min, f_next - f, grad)
+    grad = np.where(k == k_max, f - f_prev, grad)
+    grad = np.where(np.logical_and(k >= k_min, k <= k_max), grad, np.nan)
+
+    return grad
+
+
+def _nanmean_rows(f):
+    n = np.sum(~np.isnan(f), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(f, axis=1)/n
+
+
+def calc_com_angles__dask(da_objs, object_index=None):
+    """
+    Calculate approximate shear angle (theta) and xy-orientation angle (phi)
+    for all objects at once, as `calc_com_incline_and_orientation_angle` does
+    for a single object (cropped to its bounding box). The per-level
+    centre-of-mass of every object is found with a single bincount over the
+    combined (object, level) index
+    """
+    object_index = _get_object_index(da_objs, object_index)
+
+    da_objs_ = da_objs.squeeze()
+    ax_z = da_objs_.dims.index('z')
+    nz = da_objs_.shape[ax_z]
+    n_objects = len(object_index)
+
+    k = object_index.axis_index(ax_z)
+    key = object_index.segment_ids()*nz + k
+
+    N = np.bincount(key, minlength=n_objects*nz).reshape(n_objects, nz)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_c = np.bincount(
+            key, weights=_coord_values(da_objs, object_index, 'x'),
+            minlength=n_objects*nz
+        ).reshape(n_objects, nz)/N
+        y_c = np.bincount(
+            key, weights=_coord_values(da_objs, object_index, 'y'),
+            minlength=n_objects*nz
+        ).reshape(n_objects, nz)/N
+
+    # levels without any cells of an object are skipped (as when cropping
+    # with `where(..., drop=True)`), so shift the occupied levels of every
+    # object to the start of each row
+    is_occupied = N > 0
+    n_levels = is_occupied.sum(axis=1)
+    obj_n, lev_n = np.nonzero(is_occupied)
+    lev_compact = np.cumsum(is_occupied, axis=1)[obj_n, lev_n] - 1
+
+    def _compact(v):
+        v_compact = np.full((n_objects, nz), np.nan)
+        v_compact[obj_n, lev_compact] = v[obj_n, lev_n]
+        return v_compact
+
+    z = np.broadcast_to(da_objs_.z.values, (n_objects, nz))
+    k_min = np.zeros(n_objects, dtype=int)
+    k_max = n_levels - 1
+
+    with np.errstate(invalid='ignore'):
+        dx_mean = _nanmean_rows(_gradient_in_range(_compact(x_c), k_min, k_max))
+        dy_mean = _nanmean_rows(_gradient_in_range(_compact(y_c), k_min, k_max))
+        dz_mean = _nanmean_rows(_gradient_in_range(_compact(z), k_min, k_max))
+
+    dl_mean = np.sqrt(dx_mean**2. + dy_mean**2.)
+
+    theta = np.rad2deg(np.arctan2(dl_mean, dz_mean))
+    phi = np.rad2deg(np.arctan2(dy_mean, dx_mean))
+
+    # the gradient isn't defined for objects which only span one level
+    single_level = n_levels == 1
+    theta[single_level] = np.nan
+    phi[single_level] = np.nan
+
+    phi[phi < 0] += 360.
+
+    ds = xr.merge([
+        _make_per_object_da(phi, object_index, name='phi',
+                            long_name='xy-plane angle', units='deg'),
+        _make_per_object_da(theta, object_index, name='theta',
+                            long_name='z-axis slope angle', units='deg'),
+    ])
+
+    return ds
+
+def calc_vertical_flux__dask(da_objs, w, scalar, object_index=None):
+    object_index = _get_object_index(da_objs, object_index)
+
+    flux_per_cell = object_index.values(w)*object_index.values(scalar)
+    obj_flux_vals = object_index.reduce(flux_per_cell, 'sum')
+
+    return _make_per_object_da(obj_flux_vals, object_index,
+                               long_name='vertical flux',
+                               units="{} {}".format(scalar.units, w.units))
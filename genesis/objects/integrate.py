@@ -1,5 +1,7 @@
 import os
 import warnings
+from collections import OrderedDict
+from multiprocessing import Pool
 
 import xarray as xr
 import numpy as np
@@ -19,10 +21,11 @@ import numpy as np
 from scipy import ndimage
 from scipy.constants import pi
 from tqdm import tqdm
-import dask_image.ndmeasure
 
 from . import integral_properties
+from . import object_index as objects_index
 from . import minkowski_scales
+from . import label_store
 from ..utils import find_grid_spacing
 
 CHUNKS = 200  # forget about using dask for now, np.unique is too slow
@@ -35,88 +38,253 @@ def make_name(variable, operator=None):
     else:
         return variable
 
-def _integrate_scalar(objects, da, operator):
-    if 'object_ids' in da.coords:
-        object_ids = da.object_ids
-    else:
-        # print("Finding unique values")
-        object_ids = np.unique(objects.chunk(None).values)
-        # ensure object 0 (outside objects) is excluded
-        if object_ids[0] == 0:
-            object_ids = object_ids[1:]
+# operators which can be used with `integrate_scalars`
+SCALAR_OPERATORS = ['sum', 'mean', 'minimum', 'maximum', 'maximum_pos_z',
+                    'volume_integral']
+
+# operators which can be used with `integrate_profiles`
+PROFILE_OPERATORS = ['sum', 'mean', 'count', 'minimum', 'maximum']
+
+def _scalar_values(objects, da, object_index):
+    """
+    Values of `da` for every voxel of every object in the order of
+    `object_index`
+    """
+    objects = objects.squeeze()
 
     if len(da.dims) == 1 and len(objects.dims) == 3:
-        # special case for allowing integration of coordinates
-        da = xr.broadcast(objects, da)[1]
+        # special case for allowing integration of coordinates, pick out the
+        # coordinate value for each voxel from its index along the dimension
+        ax = objects.dims.index(da.dims[0])
+        return da.values[object_index.axis_index(ax)]
     else:
-        import ipdb
-        with ipdb.launch_ipdb_on_exception():
-            assert objects.dims == da.dims
-            assert objects.shape == da.shape
+        da = da.squeeze()
+        if objects.dims != da.dims or objects.shape != da.shape:
+            raise Exception("Incompatible dims/shape of `{}` ({}, {}) and "
+                            "objects ({}, {})".format(da.name, da.dims,
+                                                      da.shape, objects.dims,
+                                                      objects.shape))
+        return object_index.values(da)
+
+
+def _integrate_scalar(objects, da, operator, object_index=None, values=None):
+    if object_index is None:
+        object_index = objects_index.get_object_index(objects)
+
+    if values is None:
+        values = _scalar_values(objects=objects, da=da,
+                                object_index=object_index)
 
-    dx = find_grid_spacing(da)
+    objects = objects.squeeze()
+    if not (len(da.dims) == 1 and len(objects.dims) == 3):
+        da = da.squeeze()
+
+    dx = find_grid_spacing(objects)
 
     s = None
     if operator == "volume_integral":
-        # fn = ndimage.sum
-        fn = dask_image.ndmeasure.sum
+        vals = object_index.reduce(values, 'sum')
         s = dx**3.0
         operator_units = 'm^3'
     elif operator == "maximum_pos_z":
-        fn = dask_image.ndmeasure.maximum_position
+        vals = object_index.reduce(values, 'maximum_position')
         operator_units = 'm'
     else:
-        # fn = getattr(ndimage, operator)
-        fn = getattr(dask_image.ndmeasure, operator)
+        vals = object_index.reduce(values, operator)
         operator_units = ''
 
-    vals = fn(da, labels=objects.values, index=object_ids)
-    if hasattr(vals, 'compute'):
-        vals = vals.compute()
-
     if s is not None:
-        vals *= s
+        vals = vals*s
 
     if operator == "maximum_pos_z":
         longname = "per-object z-pos of maximum {} value".format(da.name)
         units = "m"
-        z_idxs = vals[:,da.dims.index('zt')]
-        vals = da.zt[z_idxs]
+        z_idxs = vals[:,objects.dims.index('zt')]
+        vals = objects.zt.values[z_idxs]
     else:
         longname = "per-object {} of {}".format(operator.replace('_', ' '), da.name)
         units = ("{} {}".format(da.units, operator_units)).strip()
 
-    da_integrated = xr.DataArray(vals, coords=dict(object_id=object_ids),
+    da_integrated = xr.DataArray(vals,
+                      coords=dict(object_id=object_index.object_ids),
                       dims=('object_id',),
                       attrs=dict(longname=longname, units=units),
                       name='{}__{}'.format(da.name, operator))
 
+    if 'object_ids' in da.coords:
+        da_integrated = da_integrated.sel(object_id=da.object_ids)
+
     if da.name == 'volume':
         da_integrated.name = "volume"
 
     return da_integrated
 
 
-def _integrate_per_object(da_objects, fn_int):
+def _select_objects_range(objects, da_scalar):
+    if not objects.zt.equals(da_scalar.zt):
+        warnings.warn("Objects span smaller range than scalar field to "
+                      "reducing domain of scalar field")
+        da_scalar = da_scalar.sel(zt=objects.zt)
+    return da_scalar
+
+
+def integrate_scalars(objects, variables, fields, object_index=None):
+    """
+    Integrate several scalar fields with several operators over the labelled
+    objects in `objects` at once. `variables` is a list of `(variable,
+    operator)` pairs (with the operators in `SCALAR_OPERATORS`) and `fields`
+    a dict of the scalar fields by variable name. Every field is read once and
+    all of its operators are applied to its values picked out with the object
+    index, so the labels aren't traversed again for every variable. Returns a
+    dataset with a `{variable}__{operator}` variable for each pair
+
+    >> integrate_scalars(da_objects, [('qv', 'volume_integral'),
+                                      ('w', 'maximum'),
+                                      ('qv', 'maximum_pos_z')],
+                         fields=dict(qv=da_qv, w=da_w))
+    """
+    if object_index is None:
+        object_index = objects_index.get_object_index(objects)
+
+    operators_by_variable = OrderedDict()
+    for variable, operator in variables:
+        if not operator in SCALAR_OPERATORS:
+            raise NotImplementedError("Operator `{}` not available, should be"
+                                      " one of {}".format(
+                                          operator, ", ".join(SCALAR_OPERATORS)
+                                      ))
+        operators = operators_by_variable.setdefault(variable, [])
+        if not operator in operators:
+            operators.append(operator)
+
+    das = []
+    for variable, operators in operators_by_variable.items():
+        da_scalar = _select_objects_range(objects, fields[variable].squeeze())
+        values = _scalar_values(objects=objects, da=da_scalar,
+                                object_index=object_index)
+
+        for operator in operators:
+            da_integrated = _integrate_scalar(
+                objects=objects, da=da_scalar, operator=operator,
+                object_index=object_index, values=values
+            )
+            da_integrated.name = '{}__{}'.format(variable, operator)
+            das.append(da_integrated)
+
+    return xr.merge(das)
+
+
+def integrate_profiles(objects, da, operators, dim='zt', object_index=None):
+    """
+    Compute per-object profiles of `da` along `dim` (vertical profiles by
+    default) with each operator in `operators` (one of `PROFILE_OPERATORS`),
+    for all objects and all levels at once. Returns a dataset with a
+    `{variable}__{operator}` variable of shape `(dim, object_id)` for each
+    operator
+    """
+    if object_index is None:
+        object_index = objects_index.get_object_index(objects)
+
+    objects = objects.squeeze()
+    da = _select_objects_range(objects, da.squeeze())
+    values = _scalar_values(objects=objects, da=da, object_index=object_index)
+    ax = objects.dims.index(dim)
+
+    das = []
+    for operator in operators:
+        if not operator in PROFILE_OPERATORS:
+            raise NotImplementedError("Operator `{}` not available, should be"
+                                      " one of {}".format(
+                                          operator, ", ".join(PROFILE_OPERATORS)
+                                      ))
+        vals = object_index.reduce_along(values, operator, ax=ax)
+
+        da_profile = xr.DataArray(
+            vals.T, dims=(dim, 'object_id'),
+            coords={dim: objects[dim], 'object_id': object_index.object_ids},
+            name='{}__{}'.format(da.name, operator),
+        )
+        if operator == 'count':
+            da_profile.attrs['units'] = '1'
+        elif 'units' in da.attrs:
+            da_profile.attrs['units'] = da.units
+        da_profile.attrs['long_name'] = '{} of {} per object'.format(
+            operator, da.attrs.get('long_name', da.name),
+        )
+        das.append(da_profile)
+
+    return xr.merge(das)
+
+
+def _iterate_objects_cropped(da_objects, object_ids):
+    """
+    Yield every object in `object_ids` cropped to its bounding box (as found
+    with `scipy.ndimage.find_objects`), with the values outside the object set
+    to nan, i.e. the same as `da_objects.where(da_objects == object_id,
+    drop=True)` but without comparing and copying the full domain for every
+    object
+    """
+    labels = da_objects.values
+    if labels.dtype.kind == 'f':
+        labels = np.nan_to_num(labels)
+    bboxes = ndimage.find_objects(labels.astype(int))
+
+    for object_id in object_ids:
+        object_id = int(object_id)
+        if object_id < 1 or object_id > len(bboxes) \
+                or bboxes[object_id-1] is None:
+            continue
+
+        bbox = dict(zip(da_objects.dims, bboxes[object_id-1]))
+        da_bbox = da_objects.isel(**bbox)
+        yield object_id, da_bbox.where(da_bbox == object_id)
+
+
+def _integrate_object(args):
+    fn_int, object_id, da_object = args
+    ds_object = fn_int(da_object)
+    ds_object['object_id'] = object_id
+    return ds_object
+
+
+def _integrate_per_object(da_objects, fn_int, object_index=None,
+                          n_workers=None):
+    """
+    Apply `fn_int` to every object in `da_objects` (given the object cropped
+    to its bounding box). With `n_workers` > 1 the objects are spread over a
+    pool of processes (`fn_int` must then be picklable, i.e. defined at module
+    level)
+    """
     if 'object_ids' in da_objects.coords:
-        object_ids = da_objects.object_ids
+        object_ids = da_objects.object_ids.values
     else:
-        # print("Finding unique values")
-        object_ids = np.unique(da_objects.chunk(None).values)
-        # ensure object 0 (outside objects) is excluded
-        if object_ids[0] == 0:
-            object_ids = object_ids[1:]
+        if object_index is None:
+            object_index = objects_index.get_object_index(da_objects)
+        object_ids = object_index.object_ids
 
     if 'xt' in da_objects.coords:
         da_objects = da_objects.rename(dict(xt='x', yt='y', zt='z'))
 
-    ds_per_object = []
-    for object_id in tqdm(object_ids):
-        da_object = da_objects.where(da_objects == object_id, drop=True)
+    objects_cropped = (
+        (fn_int, object_id, da_object)
+        for (object_id, da_object)
+        in _iterate_objects_cropped(da_objects, object_ids)
+    )
 
-        ds_object = fn_int(da_object)
-        ds_object['object_id'] = object_id
-        ds_per_object.append(ds_object)
+    if n_workers is not None and n_workers > 1:
+        pool = Pool(processes=n_workers)
+        try:
+            ds_per_object = list(tqdm(
+                pool.imap(_integrate_object, objects_cropped, chunksize=64),
+                total=len(object_ids)
+            ))
+        finally:
+            pool.terminate()
+    else:
+        ds_per_object = [
+            _integrate_object(args)
+            for args in tqdm(objects_cropped, total=len(object_ids))
+        ]
 
     return xr.concat(ds_per_object, dim='object_id')
 
@@ -127,7 +295,8 @@ def get_integration_requirements(variable):
     else:
         return {}
 
-def integrate(objects, variable, operator=None, **kwargs):
+def integrate(objects, variable, operator=None, object_index=None,
+              n_workers=None, **kwargs):
     """
     Integrate over the labelled objects in `objects` the variable (named by a
     string, .e.g `r_equiv` would be the equivalent spherical radius). Can also
@@ -149,21 +318,24 @@ def integrate(objects, variable, operator=None, **kwargs):
     Calculate the volume integral of water vapour for each object
 
     >> integrate(da_objects, variable='q', operator='volume_integral', q=ds.q)
+
+    The voxels of each object are found from the object index
+    (`object_index.get_object_index`) which is built once and stored next to
+    the objects file, an index can also be passed in with `object_index`.
+    Properties computed one object at a time (e.g. `com_angles`) can be spread
+    over `n_workers` processes.
     """
 
     ds_out = None
 
     if variable in objects.coords:
         da_scalar = objects.coords[variable]
-    elif variable == 'com_angles':
-        fn_int = integral_properties.calc_com_incline_and_orientation_angle
-        ds_out = _integrate_per_object(da_objects=objects, fn_int=fn_int)
     elif hasattr(integral_properties, 'calc_{}__dask'.format(variable)):
         fn_int = getattr(integral_properties, 'calc_{}__dask'.format(variable))
         da_objects = objects
         if 'xt' in da_objects.dims:
             da_objects = da_objects.rename(xt='x', yt='y', zt='z')
-        ds_out = fn_int(da_objects)
+        ds_out = fn_int(da_objects, object_index=object_index)
         try:
             ds_out.name = variable
         except AttributeError:
@@ -172,7 +344,9 @@ def integrate(objects, variable, operator=None, **kwargs):
             pass
     elif hasattr(integral_properties, 'calc_{}'.format(variable)):
         fn_int = getattr(integral_properties, 'calc_{}'.format(variable))
-        ds_out = _integrate_per_object(da_objects=objects, fn_int=fn_int)
+        ds_out = _integrate_per_object(da_objects=objects, fn_int=fn_int,
+                                       object_index=object_index,
+                                       n_workers=n_workers)
         try:
             ds_out.name = variable
         except AttributeError:
@@ -193,7 +367,8 @@ def integrate(objects, variable, operator=None, **kwargs):
         ds_minkowski = minkowski_scales.main(da_objects=objects)
         ds_out = ds_minkowski[variable]
     elif variable == 'r_equiv':
-        da_volume = integrate(objects, 'volume', operator='sum')
+        da_volume = integrate(objects, 'volume', operator='sum',
+                              object_index=object_index)
         # V = 4/3 pi r^3 => r = (3/4 V/pi)**(1./3.)
         da_scalar = (3./(4.*pi)*da_volume)**(1./3.)
         da_scalar.attrs['units'] = 'm'
@@ -201,18 +376,14 @@ def integrate(objects, variable, operator=None, **kwargs):
         da_scalar.name = 'r_equiv'
         ds_out = da_scalar
     elif variable in kwargs and operator in ['volume_integral', 'maximum', 'maximum_pos_z']:
-        da_scalar = kwargs[variable].squeeze()
-        if not objects.zt.equals(da_scalar.zt):
-            warnings.warn("Objects span smaller range than scalar field to "
-                          "reducing domain of scalar field")
-            da_scalar = da_scalar.sel(zt=objects.zt)
+        da_scalar = _select_objects_range(objects, kwargs[variable].squeeze())
 
         # ds_out = _integrate_scalar(objects=objects.squeeze(),
                                    # da=da_scalar,
                                    # operator=operator)
-        import ipdb
-        with ipdb.launch_ipdb_on_exception():
-            ds_out = _integrate_scalar(objects=objects, da=da_scalar, operator=operator)
+        ds_out = _integrate_scalar(objects=objects, da=da_scalar,
+                                   operator=operator,
+                                   object_index=object_index)
     else:
         raise NotImplementedError("Don't know how to calculate `{}`"
                                   "".format(variable))
@@ -232,7 +403,9 @@ def integrate(objects, variable, operator=None, **kwargs):
             zt_ = da_scalar.zt.values
             da_scalar = da_scalar.sel(zt=slice(None, zt_[25]))
 
-        ds_out = _integrate_scalar(objects=objects, da=da_scalar, operator=operator)
+        ds_out = _integrate_scalar(objects=objects, da=da_scalar,
+                                   operator=operator,
+                                   object_index=object_index)
 
     return ds_out
 # hack to set docstring at runtime so we can include the available variables
@@ -261,7 +434,7 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(
+    objects = label_store.open_labels(
         fn_objects, decode_times=False, chunks=CHUNKS
     ).squeeze()
 
@@ -0,0 +1,240 @@
+"""
+Compact storage of object label fields. The labels are written with the
+narrowest unsigned integer type which can hold the largest object id and with
+chunked zlib compression (`compressed`), or as the runs of non-zero labels
+along the flattened field (`rle`) which is more compact still for the mostly
+empty label fields of small objects. `open_labels` (and `decode_labels` for
+already opened datasets) reads either format back transparently as a
+`DataArray` with the original dtype
+"""
+import warnings
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+STORAGE_METHODS = ['compressed', 'rle', 'plain']
+DEFAULT_METHOD = 'compressed'
+
+COMPRESSION_LEVEL = 4
+CHUNK_SIZE = 64
+
+ENCODING_ATTR = 'label_encoding'
+DTYPE_ATTR = 'label_dtype'
+
+
+def get_label_dtype(max_id):
+    """
+    Narrowest unsigned integer type which can hold labels up to `max_id`
+    """
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_id <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def _iterate_slabs(labels):
+    """
+    Read `labels` (which may be backed by a file or dask) in slabs of
+    `CHUNK_SIZE` along the first dimension, with NaN (e.g. from masking with
+    xarray) replaced by zero
+    """
+    for k in range(0, labels.shape[0], CHUNK_SIZE):
+        slab = np.asarray(labels[k:k+CHUNK_SIZE])
+        if slab.dtype.kind == 'f':
+            slab = np.nan_to_num(slab)
+        yield slice(k, k+CHUNK_SIZE), slab
+
+
+def _get_label_range(labels):
+    l_min, l_max = 0, 0
+    for _, slab in _iterate_slabs(labels):
+        if slab.size > 0:
+            l_min = min(l_min, slab.min())
+            l_max = max(l_max, slab.max())
+    return l_min, l_max
+
+
+def _write_compressed(da_objects, fn, dtype):
+    """
+    Write the labels as `dtype` with chunked compression. The coordinates are
+    written with xarray and the labels are then added one slab at a time, so
+    that only a single slab is held in memory (as `dtype`)
+    """
+    name = da_objects.name if da_objects.name is not None else 'object_labels'
+    chunksizes = tuple([min(n, CHUNK_SIZE) for n in da_objects.shape])
+
+    attrs = dict(da_objects.attrs)
+    attrs[ENCODING_ATTR] = 'compressed'
+    attrs[DTYPE_ATTR] = str(da_objects.dtype)
+    non_dim_coords = [c for c in da_objects.coords if not c in da_objects.dims]
+    if len(non_dim_coords) > 0:
+        attrs['coordinates'] = ' '.join(non_dim_coords)
+
+    xr.Dataset(coords=da_objects.coords).to_netcdf(fn, engine='netcdf4')
+    with netCDF4.Dataset(fn, 'a') as nc:
+        for d, n in zip(da_objects.dims, da_objects.shape):
+            if not d in nc.dimensions:
+                nc.createDimension(d, n)
+        var = nc.createVariable(
+            name, dtype, da_objects.dims, zlib=True,
+            complevel=COMPRESSION_LEVEL, shuffle=True, chunksizes=chunksizes,
+            fill_value=False
+        )
+        var.setncatts(attrs)
+        for slab_slice, slab in _iterate_slabs(da_objects.data):
+            var[slab_slice] = slab.astype(dtype, copy=False)
+
+
+def _encode_rle(da_objects, dtype):
+    """
+    Store the start (flat C-order index), length and label of every run of
+    identical non-zero labels, together with the coordinates of the field
+    """
+    flat = np.concatenate([np.zeros(0, dtype=dtype)] + [
+        slab.astype(dtype, copy=False).ravel()
+        for _, slab in _iterate_slabs(da_objects.data)
+    ])
+    is_new_run = np.ones(len(flat), dtype=bool)
+    is_new_run[1:] = flat[1:] != flat[:-1]
+    starts = np.flatnonzero(is_new_run)
+    lengths = np.diff(np.append(starts, len(flat)))
+    run_labels = flat[starts]
+
+    has_label = run_labels != 0
+    starts, lengths = starts[has_label], lengths[has_label]
+    run_labels = run_labels[has_label]
+
+    ds = xr.Dataset(coords=da_objects.coords)
+    ds['run_start'] = ('run',), starts.astype(get_label_dtype(len(flat)))
+    ds['run_length'] = ('run',), lengths.astype(get_label_dtype(
+        lengths.max() if len(lengths) > 0 else 0
+    ))
+    ds['run_label'] = ('run',), run_labels.astype(get_label_dtype(
+        run_labels.max() if len(run_labels) > 0 else 0
+    ))
+    ds.attrs.update(da_objects.attrs)
+    ds.attrs[ENCODING_ATTR] = 'rle'
+    ds.attrs[DTYPE_ATTR] = str(da_objects.dtype)
+    ds.attrs['label_name'] = da_objects.name or 'object_labels'
+    ds.attrs['label_dims'] = ','.join(da_objects.dims)
+    ds.attrs['label_shape'] = ','.join([str(n) for n in da_objects.shape])
+
+    encoding = dict([
+        (v, dict(zlib=True, complevel=COMPRESSION_LEVEL))
+        for v in ['run_start', 'run_length', 'run_label']
+    ])
+    return ds, encoding
+
+
+def write_labels(da_objects, fn, method=DEFAULT_METHOD):
+    """
+    Write the object labels `da_objects` to `fn` using storage `method` (one
+    of `STORAGE_METHODS`). The labels are read in slabs and cast straight to
+    the narrowest type which can hold them, so that `compressed` labels can
+    be written from a file-backed array (for example a `np.memmap`) one slab
+    at a time. `rle` labels are always encoded in memory
+    """
+    if method == 'plain':
+        da_objects.to_netcdf(fn)
+        return
+    elif not method in STORAGE_METHODS:
+        raise NotImplementedError("Label storage method `{}` not available,"
+                                  " should be one of {}".format(
+                                      method, ", ".join(STORAGE_METHODS)))
+
+    l_min, l_max = _get_label_range(da_objects.data)
+    if l_min < 0:
+        raise Exception("Negative object labels can't be stored compactly")
+    dtype = get_label_dtype(l_max)
+
+    if method == 'compressed':
+        _write_compressed(da_objects, fn, dtype=dtype)
+    else:
+        ds, encoding = _encode_rle(da_objects, dtype=dtype)
+        ds.to_netcdf(fn, encoding=encoding)
+
+
+def decode_labels(ds):
+    """
+    Turn the opened label file `ds` (written with `write_labels`) back into a
+    `DataArray` of labels with the original dtype
+    """
+    encoding = ds.attrs.get(ENCODING_ATTR)
+    if encoding is None and isinstance(ds, xr.Dataset):
+        if len(ds.data_vars) == 1:
+            ds = ds[list(ds.data_vars)[0]]
+        encoding = ds.attrs.get(ENCODING_ATTR)
+
+    if encoding == 'rle':
+        dims = ds.attrs['label_dims'].split(',')
+        shape = [int(n) for n in ds.attrs['label_shape'].split(',')]
+        starts = ds.run_start.values.astype(np.int64)
+        lengths = ds.run_length.values.astype(np.int64)
+        run_labels = ds.run_label.values
+
+        # flat index of every labelled voxel, offset within each run added to
+        # the run's start
+        n_labelled = lengths.sum()
+        run_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        idx = np.repeat(starts, lengths) + np.arange(n_labelled) - run_offsets
+
+        labels = np.zeros(int(np.prod(shape)), dtype=ds.attrs[DTYPE_ATTR])
+        labels[idx] = np.repeat(run_labels, lengths)
+
+        # all coordinates of the labels are stored (including non-dimension
+        # ones, e.g. a scalar `time`), only the runs are along `run`
+        coords = dict([
+            (c, ds.coords[c]) for c in ds.coords
+            if not 'run' in ds.coords[c].dims
+        ])
+        attrs = dict([
+            (k, v) for (k, v) in ds.attrs.items()
+            if not k in [ENCODING_ATTR, DTYPE_ATTR, 'label_name', 'label_dims',
+                         'label_shape']
+        ])
+        da = xr.DataArray(labels.reshape(shape), dims=dims, coords=coords,
+                          attrs=attrs, name=ds.attrs['label_name'])
+        da.encoding['source'] = ds.encoding.get('source')
+        return da
+    elif encoding == 'compressed':
+        da = ds.astype(ds.attrs[DTYPE_ATTR])
+        da.encoding['source'] = ds.encoding.get('source')
+        del(da.attrs[ENCODING_ATTR])
+        del(da.attrs[DTYPE_ATTR])
+        return da
+    else:
+        return ds
+
+
+def open_labels(fn, **kwargs):
+    """
+    Open the object labels in `fn`, whichever storage method they were
+    written with. NB: labels stored as runs (`rle`) are always decoded into
+    a single in-memory array, `chunks` only has effect for the other storage
+    methods
+    """
+    ds = xr.open_dataset(fn, **kwargs)
+    ds.encoding['source'] = fn
+    if ds.attrs.get(ENCODING_ATTR) == 'rle':
+        if kwargs.get('chunks') is not None:
+            warnings.warn("The object labels in `{}` are stored as runs and"
+                          " will be decoded in full rather than in chunks,"
+                          " store them `compressed` to read them in"
+                          " chunks".format(fn))
+        return decode_labels(ds)
+
+    name = list(ds.data_vars)[0]
+    da = ds[name]
+    da.encoding['source'] = fn
+    return decode_labels(da)
+
+
+def get_labels_name(fn):
+    """
+    Name of the object labels in `fn` without reading the labels
+    """
+    with xr.open_dataset(fn, decode_times=False) as ds:
+        if ds.attrs.get(ENCODING_ATTR) == 'rle':
+            return ds.attrs['label_name']
+        return list(ds.data_vars)[0]
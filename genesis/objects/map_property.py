@@ -6,31 +6,79 @@ import warnings
 
 import xarray as xr
 import numpy as np
-import tqdm
 
 import genesis.objects
 
 
+def make_property_table(da_property):
+    """
+    Make a lookup-table over the object ids `0...max(object_id)` with the
+    value of `da_property` for each object (and NaN for ids without a value
+    and for the background, `object_id == 0`)
+    """
+    object_ids = da_property.object_id.values.astype(np.int64)
+    dtype = np.promote_types(da_property.dtype, np.float32)
+    table = np.full(object_ids.max()+1, np.nan, dtype=dtype)
+    table[object_ids] = da_property.values
+    table[0] = np.nan
+    return table
+
+
+def _lookup(labels, table):
+    if labels.dtype.kind == 'f':
+        labels = np.nan_to_num(labels)
+    labels = labels.astype(np.int64)
+    # labels outside the table have no value and are mapped onto the
+    # background
+    labels[np.logical_or(labels < 0, labels >= len(table))] = 0
+    return table[labels]
+
+
+def map_properties(objects, da_property):
+    """
+    Map the per-object values of `da_property` onto the 3D `objects` field
+    with a single lookup per voxel. `da_property` may be a single property or
+    a dataset with several properties, and `objects` may be backed by dask in
+    which case the mapping is done chunk by chunk
+    """
+    if isinstance(da_property, xr.Dataset):
+        return xr.merge([
+            map_properties(objects=objects, da_property=da_property[v])
+            for v in da_property.data_vars
+        ])
+
+    table = make_property_table(da_property)
+    properties_mapped = xr.apply_ufunc(
+        _lookup, objects, kwargs=dict(table=table), dask='parallelized',
+        output_dtypes=[table.dtype],
+    )
+    properties_mapped.attrs.update(da_property.attrs)
+    properties_mapped.name = da_property.name
+    return properties_mapped
+
+
 def map_property_onto_objects(objects, object_file, property):
+    """
+    Map the object property `property` onto `objects`, several properties
+    can be mapped at once by giving a list or a comma-separated string
+    """
     base_name, objects_mask = object_file.split('.objects.')
 
     object_properties = genesis.objects.get_data(base_name, mask_identifier=objects_mask)
-    object_property = object_properties[property]
     N_objects = len(object_properties.object_id)
 
-    properties_mapped = xr.full_like(objects, fill_value=np.nan, dtype=object_property.dtype)
-    properties_mapped.attrs.update(object_property.attrs)
-    properties_mapped.name = object_property.name
-
-    print("Mapping {} onto {} objects...".format(property, N_objects))
+    if isinstance(property, str):
+        property = property.split(',')
 
-    for object_id in tqdm.tqdm(object_properties.object_id):
-        if object_id == 0:
-            continue
-        v = object_property.sel(object_id=object_id).values
-        properties_mapped = properties_mapped.where(objects != object_id, other=v)
+    print("Mapping {} onto {} objects...".format(", ".join(property),
+                                                 N_objects))
 
-    return properties_mapped
+    if len(property) == 1:
+        return map_properties(objects=objects,
+                              da_property=object_properties[property[0]])
+    else:
+        return map_properties(objects=objects,
+                              da_property=object_properties[property])
 
 
 if __name__ == "__main__":
@@ -38,7 +86,8 @@ if __name__ == "__main__":
     argparser = argparse.ArgumentParser(description=__doc__)
 
     argparser.add_argument('object_file', type=str)
-    argparser.add_argument('property', type=str)
+    argparser.add_argument('property', type=str,
+                           help='property (or comma-separated properties)')
 
     args = argparser.parse_args()
 
@@ -52,7 +101,7 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(fn_objects, decode_times=False)
+    objects = genesis.objects.label_store.open_labels(fn_objects, decode_times=False)
 
 
     ds = map_property_onto_objects(objects=objects, object_file=object_file,
@@ -60,7 +109,7 @@ if __name__ == "__main__":
 
     out_filename = "{}.objects.{}.mapped.{}.nc".format(
         base_name.replace('/', '__'), objects_mask,
-        args.property
+        args.property.replace(',', '__')
     )
 
     ds.to_netcdf(out_filename)
@@ -5,16 +5,17 @@ functionals
 import os
 import warnings
 
-import xarray as xr
 import numpy as np
 
 import cloud_identification
 
 from . import topology
+from . import label_store
 
-def main(da_objects):
+def main(da_objects, chunk_size=None):
     dx = topology.minkowski.find_grid_spacing(da_objects)
-    return topology.minkowski.calc_scales(object_labels=da_objects, dx=dx)
+    return topology.minkowski.calc_scales(object_labels=da_objects, dx=dx,
+                                          chunk_size=chunk_size)
 
 FN_FORMAT = "{base_name}.objects.{objects_name}.minkowski_scales.nc"
 
@@ -24,6 +25,9 @@ if __name__ == "__main__":
 
     argparser.add_argument('objects_file', type=str)
     argparser.add_argument('--make-plot', action="store_true")
+    argparser.add_argument('--chunk-size', type=int, default=None,
+                           help="number of vertical levels to process at a"
+                                " time")
 
     args = argparser.parse_args()
 
@@ -41,9 +45,13 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(fn_objects, decode_times=False)
+    if args.chunk_size is not None:
+        objects = label_store.open_labels(fn_objects, decode_times=False,
+                                          chunks=dict(zt=args.chunk_size))
+    else:
+        objects = label_store.open_labels(fn_objects, decode_times=False)
 
-    ds = main(objects)
+    ds = main(objects, chunk_size=args.chunk_size)
 
     ds.attrs['input_name'] = args.objects_file
     ds.attrs['mask'] = objects_mask
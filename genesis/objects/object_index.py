@@ -0,0 +1,252 @@
+"""
+Index of the voxels belonging to each labelled object, built once per objects
+file with a single sort of the labels and stored in compressed-sparse-row
+form: the object ids, the offsets into the sorted voxels for each object and
+the flat (C-order) indices of the voxels sorted by object id. All per-object
+reductions (sums, extrema, means, ...) can then be computed directly from the
+sorted voxels without searching the 3D label array again.
+
+The index is stored next to the objects file (`{objects}.index.npz`) and is
+rebuilt if the objects file is newer than the stored index
+"""
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+FN_SUFFIX = '.index.npz'
+
+# operators that can be computed per object, named as in
+# `scipy.ndimage`/`dask_image.ndmeasure`
+OPERATORS = ['sum', 'mean', 'minimum', 'maximum', 'minimum_position',
+             'maximum_position', 'count']
+
+
+class ObjectIndex(object):
+    def __init__(self, object_ids, offsets, voxel_idx, shape, dims):
+        self.object_ids = object_ids
+        self.offsets = offsets
+        self.voxel_idx = voxel_idx
+        self.shape = tuple(shape)
+        self.dims = tuple(dims)
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def voxels(self, object_id):
+        """
+        Flat indices of the voxels of object `object_id`
+        """
+        n = np.searchsorted(self.object_ids, object_id)
+        if n == len(self.object_ids) or self.object_ids[n] != object_id:
+            raise KeyError(object_id)
+        return self.voxel_idx[self.offsets[n]:self.offsets[n+1]]
+
+    def select(self, object_ids):
+        """
+        Flat indices of all the voxels belonging to the objects in
+        `object_ids`
+        """
+        is_selected = np.isin(self.object_ids, object_ids)
+        return self.voxel_idx[np.repeat(is_selected, self.counts)]
+
+    def segment_ids(self):
+        """
+        For every sorted voxel the index of the object it belongs to
+        """
+        return np.repeat(np.arange(len(self.object_ids)), self.counts)
+
+    def axis_index(self, ax):
+        """
+        For every sorted voxel the index along axis `ax`
+        """
+        stride = int(np.prod(self.shape[ax+1:]))
+        return (self.voxel_idx // stride) % self.shape[ax]
+
+    def values(self, da):
+        """
+        Values of `da` (with the same shape and dimension order as the
+        objects) for every sorted voxel
+        """
+        if not da.shape == self.shape:
+            da = da.squeeze()
+        if not da.shape == self.shape:
+            raise Exception("Shape of `{}` {} doesn't match the objects {}"
+                            "".format(da.name, da.shape, self.shape))
+
+        values = np.asarray(getattr(da, 'values', da))
+        return values.ravel()[self.voxel_idx]
+
+    def reduce(self, values, operator):
+        """
+        Reduce the `values` (one per sorted voxel, see `values` and
+        `axis_index`) for every object with `operator` (one of `OPERATORS`).
+        The positions returned by `minimum_position` and `maximum_position`
+        are tuples of indices, as with `scipy.ndimage`
+        """
+        if len(self.object_ids) == 0:
+            return np.array([])
+
+        if values.dtype == bool:
+            values = values.astype(np.int64)
+
+        starts = self.offsets[:-1]
+        if operator == 'sum':
+            return np.add.reduceat(values, starts)
+        elif operator == 'count':
+            return self.counts
+        elif operator == 'mean':
+            return np.add.reduceat(values, starts, dtype=np.float64)/self.counts
+        elif operator == 'minimum':
+            return np.minimum.reduceat(values, starts)
+        elif operator == 'maximum':
+            return np.maximum.reduceat(values, starts)
+        elif operator in ['minimum_position', 'maximum_position']:
+            ufunc = np.minimum if operator == 'minimum_position' else np.maximum
+            v_ext = np.repeat(ufunc.reduceat(values, starts), self.counts)
+            n_match = np.flatnonzero(values == v_ext)
+            segment = self.segment_ids()[n_match]
+            # voxels are sorted by flat index within each object so the first
+            # match is the first occurrence in C-order
+            is_first = np.ones(len(n_match), dtype=bool)
+            is_first[1:] = segment[1:] != segment[:-1]
+            flat_idx = self.voxel_idx[n_match[is_first]]
+            return np.array(np.unravel_index(flat_idx, self.shape)).T
+        else:
+            raise NotImplementedError("Operator `{}` not available, should be"
+                                      " one of {}".format(operator,
+                                                          ", ".join(OPERATORS)))
+
+    def reduce_along(self, values, operator, ax):
+        """
+        Reduce the `values` (one per sorted voxel) with `operator` separately
+        for every object and every position along axis `ax` (for example to
+        compute per-object vertical profiles), using a single combined
+        (object, position) key for all objects at once. Returns an array of
+        shape `(len(self), self.shape[ax])`, with zero sums and counts and NaN
+        for the other operators where an object doesn't occupy a position
+        """
+        n_pos = self.shape[ax]
+        n_keys = len(self.object_ids)*n_pos
+        key = self.segment_ids()*n_pos + self.axis_index(ax)
+
+        if values.dtype == bool:
+            values = values.astype(np.int64)
+
+        counts = np.bincount(key, minlength=n_keys)
+        if operator == 'count':
+            vals = counts
+        elif operator in ['sum', 'mean']:
+            vals = np.bincount(key, weights=values, minlength=n_keys)
+            if operator == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    vals = vals/counts
+        elif operator in ['minimum', 'maximum']:
+            ufunc = np.minimum if operator == 'minimum' else np.maximum
+            order = np.argsort(key, kind='stable')
+            key_sorted = key[order]
+            starts = np.flatnonzero(np.r_[True, key_sorted[1:] != key_sorted[:-1]])
+            vals = np.full(n_keys, np.nan)
+            vals[key_sorted[starts]] = ufunc.reduceat(values[order], starts)
+        else:
+            raise NotImplementedError("Operator `{}` not available, should be"
+                                      " one of sum, mean, count, minimum, "
+                                      "maximum".format(operator))
+
+        return vals.reshape((len(self.object_ids), n_pos))
+
+    def save(self, fn):
+        """
+        Store the index in `fn`. The file is replaced atomically so that
+        several processes can share the same index file
+        """
+        p_dir = os.path.dirname(os.path.abspath(fn))
+        fh, fn_tmp = tempfile.mkstemp(dir=p_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fh, 'wb') as fh:
+                np.savez(fh, object_ids=self.object_ids, offsets=self.offsets,
+                         voxel_idx=self.voxel_idx, shape=np.array(self.shape),
+                         dims=np.array(self.dims))
+            os.replace(fn_tmp, fn)
+        except:
+            if os.path.exists(fn_tmp):
+                os.remove(fn_tmp)
+            raise
+
+    @staticmethod
+    def load(fn):
+        with np.load(fn) as f:
+            return ObjectIndex(object_ids=f['object_ids'],
+                               offsets=f['offsets'],
+                               voxel_idx=f['voxel_idx'], shape=f['shape'],
+                               dims=[str(d) for d in f['dims']])
+
+
+def build_object_index(da_objects):
+    """
+    Build the index of the voxels of every (non-zero) object in `da_objects`
+    with a single sort of the labelled voxels
+    """
+    da_objects = da_objects.squeeze()
+    labels = np.asarray(da_objects.values).ravel()
+    if labels.dtype.kind == 'f':
+        labels = np.nan_to_num(labels)
+    labels = labels.astype(np.int64)
+
+    voxel_idx = np.flatnonzero(labels)
+    voxel_labels = labels[voxel_idx]
+    order = np.argsort(voxel_labels, kind='stable')
+    voxel_idx = voxel_idx[order]
+
+    counts = np.bincount(voxel_labels)
+    object_ids = np.flatnonzero(counts)
+    offsets = np.zeros(len(object_ids)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[object_ids])
+
+    return ObjectIndex(object_ids=object_ids, offsets=offsets,
+                       voxel_idx=voxel_idx, shape=da_objects.shape,
+                       dims=da_objects.dims)
+
+
+def make_index_filename(fn_objects):
+    return os.path.splitext(fn_objects)[0] + FN_SUFFIX
+
+
+def get_object_index(da_objects):
+    """
+    Get the index for `da_objects`, reading it from next to the objects file
+    the labels were loaded from if it has been stored there already (and
+    storing it there otherwise). If the source file isn't known the index is
+    built in memory
+    """
+    fn_objects = da_objects.encoding.get('source')
+    shape = tuple(da_objects.squeeze().shape)
+
+    if fn_objects is None or not os.path.exists(fn_objects):
+        return build_object_index(da_objects)
+
+    fn_index = make_index_filename(fn_objects)
+    if (os.path.exists(fn_index)
+            and os.path.getmtime(fn_index) >= os.path.getmtime(fn_objects)):
+        try:
+            object_index = ObjectIndex.load(fn_index)
+        except (IOError, zipfile.BadZipFile, KeyError, ValueError):
+            # index unreadable (for example written by an older version),
+            # rebuild it below
+            object_index = None
+        if (object_index is not None and object_index.shape == shape
+                and object_index.offsets[-1] == len(object_index.voxel_idx)):
+            return object_index
+
+    object_index = build_object_index(da_objects)
+    try:
+        object_index.save(fn_index)
+    except IOError:
+        pass
+
+    return object_index
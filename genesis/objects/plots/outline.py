@@ -2,11 +2,12 @@ if __name__ == "__main__":
     import matplotlib
     matplotlib.use("Agg")
 
-import xarray as xr
 import matplotlib.pyplot as plt
 import numpy as np
 import tqdm
 
+from genesis.objects.label_store import open_labels
+
 
 def cumsum_cutoff(v, frac=0.9):
     s = np.cumsum(v)
@@ -59,7 +60,7 @@ if __name__ == "__main__":
 
     args = argparser.parse_args()
 
-    da = xr.open_dataarray(args.objects_filename, decode_times=False)
+    da = open_labels(args.objects_filename, decode_times=False)
 
     plot_outline(da=da, lx=args.lx, frac=args.frac)
 
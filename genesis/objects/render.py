@@ -6,6 +6,7 @@ from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 unused import
 import matplotlib.pyplot as plt
 
 from ..utils import find_grid_spacing
+from .label_store import open_labels
 
 
 def render_mask_as_3d_voxels(da_mask, ax=None, center_xy_pos=False, alpha=0.5):
@@ -86,7 +87,7 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    da_objects = xr.open_dataarray(fn_objects, decode_times=False)
+    da_objects = open_labels(fn_objects, decode_times=False)
 
     if not args.object_id in da_objects.values:
         raise Exception()
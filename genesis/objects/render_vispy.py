@@ -28,6 +28,8 @@ import xarray as xr
 
 import numpy as np
 
+from genesis.objects.label_store import open_labels
+
 from vispy import app, scene, io
 from vispy.color import get_colormaps, BaseColormap
 from vispy.visuals.transforms import STTransform
@@ -201,7 +203,7 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(fn_objects, decode_times=False)
+    objects = open_labels(fn_objects, decode_times=False)
 
     if not args.object_id in objects.values:
         raise Exception()
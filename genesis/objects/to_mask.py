@@ -3,7 +3,7 @@ Create a 3D mask from labelled objects
 """
 import os
 
-import xarray as xr
+from genesis.objects.label_store import open_labels
 
 
 def create_mask_from_objects(objects):
@@ -28,7 +28,7 @@ if __name__ == "__main__":
     fn_objects = "{}.nc".format(object_file)
     if not os.path.exists(fn_objects):
         raise Exception("Couldn't find objects file `{}`".format(fn_objects))
-    objects = xr.open_dataarray(fn_objects, decode_times=False)
+    objects = open_labels(fn_objects, decode_times=False)
 
 
     ds = create_mask_from_objects(objects=objects)
@@ -10,14 +10,53 @@ import numpy as np
 
 import cloud_identification
 
+from . import minkowski_voxels
 
-def calc_scales(object_labels, dx):
+# the Minkowski functionals can either be computed with the compiled routines
+# in `cloud_identification` or with the numpy implementation in
+# `minkowski_voxels`, selected with `GENESIS_MINKOWSKI_ENGINE`
+ENGINES = ['cloud_identification', 'numpy']
+
+
+def get_engine():
+    engine = os.environ.get('GENESIS_MINKOWSKI_ENGINE', 'cloud_identification')
+    if not engine in ENGINES:
+        raise NotImplementedError("Minkowski engine `{}` not available, should"
+                                  " be one of {}".format(engine,
+                                                         ", ".join(ENGINES)))
+    return engine
+
+
+def calc_scales(object_labels, dx, engine=None, chunk_size=None):
     """
     Compute characteristic scales from Minkowski functionals in 3D using
-    labelled objects in `object_labels`
+    labelled objects in `object_labels`. With `chunk_size` set the labels
+    are processed in slabs of `chunk_size` vertical levels at a time (using
+    the numpy engine), so that `object_labels` can be backed by a file or
+    dask and doesn't need to fit in memory (labels stored as runs are
+    decoded in full when opened, see `label_store.open_labels`)
     """
-    mf = cloud_identification.topological_scales(labels=object_labels, dx=dx)
-    V0 = cloud_identification.N3(object_labels)
+    if engine is None:
+        engine = get_engine()
+
+    if chunk_size is not None:
+        if engine != 'numpy':
+            warnings.warn("Using numpy Minkowski engine to compute scales in"
+                          " chunks")
+        lib = minkowski_voxels
+        n_cells = minkowski_voxels.count_cells_chunked(
+            object_labels, chunk_size=chunk_size, dim='zt'
+        )
+        mf = lib.topological_scales(None, dx=dx, n_cells=n_cells)
+        V0 = n_cells[0,1:]
+    else:
+        if engine == 'numpy':
+            lib = minkowski_voxels
+        else:
+            lib = cloud_identification
+
+        mf = lib.topological_scales(object_labels, dx=dx)
+        V0 = lib.N3(object_labels)
 
     n_objects = mf.shape[1]
     # the cloud_identification code doesn't return properties for the zeroth
@@ -29,8 +68,8 @@ def calc_scales(object_labels, dx):
     V0 = V0[nn]
     object_ids = object_ids[nn]
 
-    planarity = cloud_identification.planarity(mf=mf)
-    filamentarity = cloud_identification.filamentarity(mf=mf)
+    planarity = lib.planarity(mf=mf)
+    filamentarity = lib.filamentarity(mf=mf)
 
     ds = xr.Dataset(coords=dict(object_id=object_ids))
 
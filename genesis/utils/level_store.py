@@ -0,0 +1,69 @@
+"""
+Level-major chunked storage of 3D fields. The field is written to a
+netCDF4/HDF5 file with one chunk per vertical level so that reading a
+horizontal cross-section (or a block of levels) only reads the chunks for
+those levels, rather than scanning the whole 3D array
+"""
+import os
+import tempfile
+
+import xarray as xr
+
+Z_DIM = 'zt'
+LEVELS_PER_BLOCK = 8
+
+
+def make_store_filename(fn):
+    return os.path.splitext(fn)[0] + '.level_chunked.nc'
+
+
+def write_level_store(da, fn, levels_per_block=LEVELS_PER_BLOCK):
+    """
+    Write `da` to `fn` with one chunk per level. The input is read in blocks of
+    `levels_per_block` levels so that the store is populated in a single
+    streaming pass without loading the whole field into memory. The file is
+    written to a temporary file first so that an incomplete store is never
+    picked up
+    """
+    if not Z_DIM in da.dims:
+        raise Exception("`{}` doesn't have a `{}` dimension".format(
+                        da.name, Z_DIM))
+
+    chunksizes = tuple([
+        1 if d in [Z_DIM, 'time'] else n for (d, n) in zip(da.dims, da.shape)
+    ])
+
+    da = da.chunk({Z_DIM: levels_per_block})
+
+    name = da.name if da.name is not None else 'data'
+    ds = da.to_dataset(name=name)
+    encoding = {name: dict(chunksizes=chunksizes)}
+
+    p_dir = os.path.dirname(os.path.abspath(fn))
+    fh, fn_tmp = tempfile.mkstemp(dir=p_dir, suffix='.nc.tmp')
+    os.close(fh)
+    try:
+        ds.to_netcdf(fn_tmp, encoding=encoding, engine='netcdf4')
+        os.rename(fn_tmp, fn)
+    finally:
+        if os.path.exists(fn_tmp):
+            os.remove(fn_tmp)
+
+
+def get_level_store(da):
+    """
+    Return the level-chunked copy of `da` (which must have its `from_file`
+    attribute set), creating it next to the source file if it doesn't exist
+    yet
+    """
+    fn_store = make_store_filename(da.from_file)
+
+    if not os.path.exists(fn_store):
+        write_level_store(da, fn_store)
+
+    da_store = xr.open_dataarray(fn_store, decode_times=False)
+    # copy over the shorthand name so that they can be used when naming the
+    # cumulant
+    da_store.name = da.name
+
+    return da_store
@@ -1,5 +1,6 @@
 import os
 import subprocess
+import tempfile
 from pathlib import Path
 import re
 import warnings
@@ -14,7 +15,7 @@ import yaml
 import hues
 from tqdm import tqdm
 
-from .. import mask_functions, make_mask
+from .. import mask_functions, make_mask, level_store
 from ... import objects
 from ...bulk_statistics import cross_correlation_with_height
 from ...utils import find_vertical_grid_spacing, calc_flux
@@ -24,8 +25,6 @@ from ... import length_scales
 
 import cloud_identification
 
-import dask_image
-
 if 'USE_SCHEDULER' in os.environ:
     from dask.distributed import Client
     client = Client(threads_per_worker=1)
@@ -100,11 +99,15 @@ class XArrayTarget(luigi.target.FileSystemTarget):
         # ds = xr.open_dataset(self.path, engine='h5netcdf', *args, **kwargs)
         ds = xr.open_dataset(self.path, *args, **kwargs)
 
+        if ds.attrs.get(objects.label_store.ENCODING_ATTR) is not None:
+            # object labels stored in a compact format
+            return objects.label_store.decode_labels(ds)
+
         if len(ds.data_vars) == 1:
             name = list(ds.data_vars)[0]
             da = ds[name]
             da.name = name
-            return da
+            return objects.label_store.decode_labels(da)
         else:
             return ds
 
@@ -238,6 +241,23 @@ class ExtractField3D(luigi.Task):
         return t
 
 
+class ExtractLevelChunkedField3D(luigi.Task):
+    base_name = luigi.Parameter()
+    field_name = luigi.Parameter()
+
+    def requires(self):
+        return ExtractField3D(base_name=self.base_name,
+                              field_name=self.field_name)
+
+    def run(self):
+        da = self.input().open(decode_times=False)
+        level_store.write_level_store(da, self.output().fn)
+
+    def output(self):
+        fn = level_store.make_store_filename(self.input().fn)
+        return XArrayTarget(fn)
+
+
 class MakeMask(luigi.Task):
     base_name = luigi.Parameter()
     method_extra_args = luigi.Parameter(default='')
@@ -411,6 +431,9 @@ class FilterObjects(luigi.Task):
     mask_method_extra_args = luigi.Parameter(default='')
     object_splitting_scalar = luigi.Parameter()
     filter_defs = luigi.Parameter()
+    label_storage = luigi.Parameter(
+        default=objects.label_store.DEFAULT_METHOD, significant=False
+    )
 
     def requires(self):
         filters = self._parse_filter_defs()
@@ -420,6 +443,7 @@ class FilterObjects(luigi.Task):
             splitting_scalar=self.object_splitting_scalar,
             mask_method=self.mask_method,
             mask_method_extra_args=self.mask_method_extra_args,
+            label_storage=self.label_storage,
         )
 
         reqs['props'] = [
@@ -446,7 +470,7 @@ class FilterObjects(luigi.Task):
                     prop_name, op_name = s_prop_and_op[:i], s_prop_and_op[i+2:]
                     op = dict(lt="less_than", gt="greater_than", eq="equals")[op_name]
                     value = float(s_value)
-                    fn_base = objects.filter.filter_objects_by_property
+                    fn_base = objects.filter.find_objects_by_property
                     fn = partial(fn_base, op=op, value=value)
 
                     filters['reqd_props'].append(prop_name)
@@ -459,16 +483,49 @@ class FilterObjects(luigi.Task):
                                 s_filter))
         return filters
 
+    def find_kept_object_ids(self, props):
+        # ids of the objects kept by all the filters, using the opened
+        # property inputs `props` (as required by this task), this doesn't
+        # require the objects themselves
+        filters = self._parse_filter_defs()
+        object_ids = None
+        for fn, prop in zip(filters['fns'], props):
+            ids = fn(da_property=prop.open())
+            if object_ids is None:
+                object_ids = ids
+            else:
+                object_ids = np.intersect1d(object_ids, ids)
+        return object_ids
+
     def run(self):
         input = self.input()
         da_obj = input['objects'].open()
 
         filters = self._parse_filter_defs()
 
+        # combine all the filters into a single lookup-table so that the
+        # objects are only relabelled once
+        max_id = objects.filter.get_max_object_id(da_obj)
+        table = None
+        mask_name = da_obj.mask_name
         for fn, prop in zip(filters['fns'], input['props']):
-            da_obj = fn(objects=da_obj, da_property=prop.open())
+            da_property = prop.open()
+            object_ids = fn(da_property=da_property)
+            table = objects.filter.make_filter_table(object_ids, max_id=max_id,
+                                                     table=table)
+            mask_name = objects.filter.make_filtered_mask_name(
+                mask_name=mask_name, da_property=da_property,
+                op=fn.keywords['op'], value=fn.keywords['value']
+            )
 
-        da_obj.to_netcdf(self.output().fn)
+        input_name = da_obj.name
+        if table is not None:
+            da_obj = objects.filter.relabel_objects(da_obj, table)
+            da_obj.attrs['input_name'] = input_name
+            da_obj.attrs['mask_name'] = mask_name
+
+        objects.label_store.write_labels(da_obj, self.output().fn,
+                                         method=self.label_storage)
 
     def output(self):
         mask_name = MakeMask.make_mask_name(
@@ -494,6 +551,14 @@ class IdentifyObjects(luigi.Task):
     mask_method = luigi.Parameter()
     mask_method_extra_args = luigi.Parameter(default='')
     filters = luigi.Parameter(default=None)
+    label_storage = luigi.Parameter(
+        default=objects.label_store.DEFAULT_METHOD, significant=False
+    )
+    # without a splitting scalar (`none`) the objects are the connected
+    # regions of the mask, which can be labelled in horizontal tiles of
+    # `chunk_size` points
+    chunk_size = luigi.IntParameter(default=None, significant=False)
+    n_workers = luigi.IntParameter(default=1, significant=False)
 
     def requires(self):
         if self.filters is not None:
@@ -503,32 +568,69 @@ class IdentifyObjects(luigi.Task):
                 mask_method=self.mask_method,
                 mask_method_extra_args=self.mask_method_extra_args,
                 filter_defs=self.filters,
+                label_storage=self.label_storage,
             )
         else:
-            return dict(
+            reqs = dict(
                 mask=MakeMask(
                     base_name=self.base_name,
                     method_name=self.mask_method,
                     method_extra_args=self.mask_method_extra_args
                 ),
-                scalar=ExtractField3D(
+            )
+            if self.splitting_scalar != objects.identify.NO_SPLITTING:
+                reqs['scalar'] = ExtractField3D(
                     base_name=self.base_name,
                     field_name=self.splitting_scalar
                 )
-            )
+            return reqs
 
     def run(self):
         if self.filters is not None:
             pass
         else:
             da_mask = xr.open_dataarray(self.input()['mask'].fn).squeeze()
-            da_scalar = xr.open_dataarray(self.input()['scalar'].fn).squeeze()
+            if 'scalar' in self.input():
+                da_scalar = xr.open_dataarray(
+                    self.input()['scalar'].fn
+                ).squeeze()
+            else:
+                da_scalar = None
+
+            if self.chunk_size is None:
+                object_labels = objects.identify.label_objects(
+                    mask=da_mask, splitting_scalar=da_scalar,
+                )
+                objects.label_store.write_labels(
+                    object_labels, self.output().fn, method=self.label_storage
+                )
+            else:
+                self._label_chunked(da_mask=da_mask, da_scalar=da_scalar)
 
+    def _label_chunked(self, da_mask, da_scalar):
+        # the labels are written tile by tile to a memory-mapped temporary
+        # file next to the output and encoded from there in slabs, so that
+        # the full-domain labels are never held in memory
+        fn_out = self.output().fn
+        chunks = dict(xt=self.chunk_size, yt=self.chunk_size)
+
+        fh, fn_tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fn_out)), suffix='.labels.tmp'
+        )
+        os.close(fh)
+        try:
+            out = np.memmap(fn_tmp, dtype=np.uint32, mode='w+',
+                            shape=da_mask.shape)
             object_labels = objects.identify.label_objects(
-                mask=da_mask, splitting_scalar=da_scalar
+                mask=da_mask, splitting_scalar=da_scalar, chunks=chunks,
+                n_workers=self.n_workers, out=out,
             )
-
-            object_labels.to_netcdf(self.output().fn)
+            objects.label_store.write_labels(
+                object_labels, fn_out, method=self.label_storage
+            )
+            del(object_labels, out)
+        finally:
+            os.remove(fn_tmp)
 
     @staticmethod
     def make_name(base_name, mask_method, mask_method_extra_args,
@@ -567,14 +669,158 @@ class IdentifyObjects(luigi.Task):
 
         return XArrayTarget(str(p))
 
+class BuildComponentTree(luigi.Task):
+    base_name = luigi.Parameter()
+    field_name = luigi.Parameter()
+    threshold_min = luigi.FloatParameter()
+
+    def requires(self):
+        return ExtractField3D(base_name=self.base_name,
+                              field_name=self.field_name)
+
+    def run(self):
+        da = self.input().open(decode_times=False)
+        tree = objects.component_tree.build_component_tree(
+            da_scalar=da, threshold_min=self.threshold_min
+        )
+        tree.save(self.output().path)
+
+    def output(self):
+        fn = objects.component_tree.make_tree_filename(
+            self.input().fn, threshold_min=self.threshold_min
+        )
+        return luigi.LocalTarget(fn)
+
+
+class ComputeObjectCountsByThreshold(luigi.Task):
+    base_name = luigi.Parameter()
+    field_name = luigi.Parameter()
+    thresholds = luigi.Parameter(default='1.0,1.5,2.0')
+
+    def _get_thresholds(self):
+        return [float(t) for t in self.thresholds.split(',')]
+
+    def requires(self):
+        return BuildComponentTree(
+            base_name=self.base_name, field_name=self.field_name,
+            threshold_min=min(self._get_thresholds()),
+        )
+
+    def run(self):
+        tree = objects.component_tree.ComponentTree.load(self.input().path)
+        thresholds = self._get_thresholds()
+
+        da = xr.DataArray(tree.count_objects(thresholds),
+                          coords=dict(threshold=thresholds),
+                          dims=('threshold',), name='num_objects')
+        da.attrs['long_name'] = 'number of objects with {} above threshold'.format(
+            self.field_name
+        )
+        da.attrs['units'] = '1'
+        da.to_netcdf(self.output().fn)
+
+    def output(self):
+        identifier = hashlib.md5(self.thresholds.encode('utf-8')).hexdigest()
+        fn = "{}.{}.num_objects_by_threshold.{}.nc".format(
+            self.base_name, self.field_name, identifier
+        )
+        p = WORKDIR/self.base_name/fn
+        return XArrayTarget(str(p))
+
+
+class IdentifyObjectsByThreshold(luigi.Task):
+    base_name = luigi.Parameter()
+    field_name = luigi.Parameter()
+    threshold = luigi.FloatParameter()
+    # lowest threshold of the component tree, share a tree between several
+    # thresholds by setting this to the lowest of them
+    threshold_min = luigi.FloatParameter(default=None)
+    label_storage = luigi.Parameter(
+        default=objects.label_store.DEFAULT_METHOD, significant=False
+    )
+
+    def requires(self):
+        threshold_min = self.threshold_min
+        if threshold_min is None:
+            threshold_min = self.threshold
+
+        return dict(
+            tree=BuildComponentTree(
+                base_name=self.base_name, field_name=self.field_name,
+                threshold_min=threshold_min,
+            ),
+            field=ExtractField3D(
+                base_name=self.base_name, field_name=self.field_name
+            ),
+        )
+
+    def _get_mask_name(self):
+        return "{}__gt{}".format(self.field_name, self.threshold)
+
+    def run(self):
+        inputs = self.input()
+        tree = objects.component_tree.ComponentTree.load(inputs['tree'].path)
+        da_field = inputs['field'].open(decode_times=False).squeeze()
+
+        mask_name = self._get_mask_name()
+        object_labels = xr.DataArray(
+            tree.labels(self.threshold), coords=da_field.coords,
+            dims=da_field.dims,
+            name=objects.identify.make_objects_name(
+                mask_name=mask_name,
+                splitting_var=objects.identify.NO_SPLITTING
+            )
+        )
+        object_labels.attrs['mask_name'] = mask_name
+        object_labels.attrs['splitting_scalar'] = objects.identify.NO_SPLITTING
+
+        objects.label_store.write_labels(object_labels, self.output().fn,
+                                         method=self.label_storage)
+
+    def output(self):
+        objects_name = objects.identify.make_objects_name(
+            mask_name=self._get_mask_name(),
+            splitting_var=objects.identify.NO_SPLITTING
+        )
+        fn = objects.identify.OUT_FILENAME_FORMAT.format(
+            base_name=self.base_name, objects_name=objects_name
+        )
+        p = WORKDIR/self.base_name/fn
+        return XArrayTarget(str(p))
+
 class ComputeObjectMinkowskiScales(luigi.Task):
     object_splitting_scalar = luigi.Parameter()
     base_name = luigi.Parameter()
     mask_method = luigi.Parameter()
     mask_method_extra_args = luigi.Parameter(default='')
     object_filters = luigi.Parameter(default=None)
+    chunk_size = luigi.IntParameter(default=None, significant=False)
+
+    def _get_filter_task(self):
+        return FilterObjects(
+            base_name=self.base_name,
+            object_splitting_scalar=self.object_splitting_scalar,
+            mask_method=self.mask_method,
+            mask_method_extra_args=self.mask_method_extra_args,
+            filter_defs=self.object_filters,
+        )
 
     def requires(self):
+        if self.object_filters is not None:
+            # the filters only remove whole objects, so the scales of the
+            # objects which are kept are picked out of the scales computed
+            # for all the objects rather than computing them again
+            return dict(
+                scales=ComputeObjectMinkowskiScales(
+                    base_name=self.base_name,
+                    object_splitting_scalar=self.object_splitting_scalar,
+                    mask_method=self.mask_method,
+                    mask_method_extra_args=self.mask_method_extra_args,
+                    chunk_size=self.chunk_size,
+                ),
+                props=self._get_filter_task().requires()['props'],
+            )
+
         return IdentifyObjects(
             base_name=self.base_name,
             splitting_scalar=self.object_splitting_scalar,
@@ -584,18 +830,44 @@ class ComputeObjectMinkowskiScales(luigi.Task):
         )
 
     def run(self):
-        da_objects = xr.open_dataarray(self.input().fn)
+        if self.object_filters is not None:
+            inputs = self.input()
+            ds = inputs['scales'].open()
+            object_ids = self._get_filter_task().find_kept_object_ids(
+                props=inputs['props']
+            )
+            ds = ds.sel(object_id=np.intersect1d(ds.object_id, object_ids))
+            ds.attrs['object_filters'] = self.object_filters
+            ds.to_netcdf(self.output().fn)
+            return
+
+        if self.chunk_size is not None:
+            da_objects = objects.label_store.open_labels(
+                self.input().fn, chunks=dict(zt=self.chunk_size)
+            )
+        else:
+            da_objects = objects.label_store.open_labels(self.input().fn)
 
-        ds = objects.minkowski_scales.main(da_objects=da_objects)
+        ds = objects.minkowski_scales.main(da_objects=da_objects,
+                                           chunk_size=self.chunk_size)
 
         ds.to_netcdf(self.output().fn)
 
     def output(self):
-        if not self.input().exists():
+        if self.object_filters is not None:
+            objects_name = IdentifyObjects.make_name(
+                base_name=self.base_name,
+                mask_method=self.mask_method,
+                mask_method_extra_args=self.mask_method_extra_args,
+                object_splitting_scalar=self.object_splitting_scalar,
+                filter_defs=self.object_filters,
+            )
+        elif not self.input().exists():
             return luigi.LocalTarget("fakefile.nc")
-
-        da_objects = xr.open_dataarray(self.input().fn, decode_times=False)
-        objects_name = da_objects.name
+        else:
+            objects_name = objects.label_store.get_labels_name(
+                self.input().fn
+            )
 
         fn = objects.minkowski_scales.FN_FORMAT.format(
             base_name=self.base_name, objects_name=objects_name
@@ -611,6 +883,7 @@ class ComputeObjectScale(luigi.Task):
     mask_method_extra_args = luigi.Parameter(default='')
 
     variable = luigi.Parameter()
+    n_workers = luigi.IntParameter(default=1, significant=False)
 
     def requires(self):
         reqs = {}
@@ -663,16 +936,72 @@ class ComputeObjectScale(luigi.Task):
 
     def run(self):
         inputs = self.input()
-        da_objects = xr.open_dataarray(inputs.pop('objects').fn)
+        da_objects = objects.label_store.open_labels(inputs.pop('objects').fn)
         kwargs = dict((k, v.open()) for (k, v) in inputs.items())
 
         variable, operator = self._get_var_and_op()
         ds = objects.integrate.integrate(objects=da_objects,
                                          variable=variable,
                                          operator=operator,
+                                         n_workers=self.n_workers,
                                          **kwargs)
         ds.to_netcdf(self.output().fn)
 
+class ComputeObjectScalarIntegrals(luigi.Task):
+    object_splitting_scalar = luigi.Parameter()
+    base_name = luigi.Parameter()
+    mask_method = luigi.Parameter()
+    mask_method_extra_args = luigi.Parameter(default='')
+
+    variables = luigi.Parameter(default='qv__volume_integral,w__maximum')
+
+    def _get_vars_and_ops(self):
+        return [v.split('__') for v in self.variables.split(',')]
+
+    def requires(self):
+        reqs = {}
+
+        reqs['objects'] = IdentifyObjects(
+            base_name=self.base_name,
+            splitting_scalar=self.object_splitting_scalar,
+            mask_method=self.mask_method,
+            mask_method_extra_args=self.mask_method_extra_args,
+        )
+
+        for v, _ in self._get_vars_and_ops():
+            reqs[v] = ExtractField3D(base_name=self.base_name, field_name=v)
+
+        return reqs
+
+    def output(self):
+        objects_name = IdentifyObjects.make_name(
+            base_name=self.base_name,
+            mask_method=self.mask_method,
+            mask_method_extra_args=self.mask_method_extra_args,
+            object_splitting_scalar=self.object_splitting_scalar,
+            filter_defs=None,
+        )
+
+        identifier = hashlib.md5(self.variables.encode('utf-8')).hexdigest()
+        fn = objects.integrate.FN_OUT_FORMAT.format(
+            base_name=self.base_name, objects_name=objects_name,
+            name="scalar_integrals.{}".format(identifier)
+        )
+        p = WORKDIR/self.base_name/fn
+        return XArrayTarget(str(p))
+
+    def run(self):
+        inputs = self.input()
+        da_objects = objects.label_store.open_labels(inputs.pop('objects').fn)
+        fields = dict((k, v.open()) for (k, v) in inputs.items())
+
+        ds = objects.integrate.integrate_scalars(
+            objects=da_objects, variables=self._get_vars_and_ops(),
+            fields=fields
+        )
+        ds.to_netcdf(self.output().fn)
+
+
 def merge_object_datasets(dss):
     def _strip_coord(ds_):
         """
@@ -741,6 +1070,25 @@ class ComputeObjectScales(luigi.Task):
             # we only want to call each method once
             variables_mapped = set(variables_mapped)
 
+            # scalar fields integrated with the simple operators are all
+            # computed together so that the objects are only indexed once
+            scalar_integrals = sorted([
+                v for v in variables_mapped
+                if '__' in v and v.split('__')[-1]
+                    in objects.integrate.SCALAR_OPERATORS
+            ])
+            if len(scalar_integrals) > 0:
+                reqs.append(
+                    ComputeObjectScalarIntegrals(
+                        base_name=self.base_name,
+                        object_splitting_scalar=self.object_splitting_scalar,
+                        mask_method=self.mask_method,
+                        mask_method_extra_args=self.mask_method_extra_args,
+                        variables=",".join(scalar_integrals),
+                    )
+                )
+            variables_mapped -= set(scalar_integrals)
+
             for v in variables_mapped:
                 if v == 'minkowski':
                     reqs.append(
@@ -920,14 +1268,21 @@ class ExtractCumulantScaleProfile(luigi.Task):
     mask = luigi.Parameter(default=None)
     mask_args = luigi.Parameter(default='')
     width_method = length_scales.cumulant.calc.WidthEstimationMethod.MASS_WEIGHTED
+    n_workers = luigi.IntParameter(default=1, significant=False)
+    z_batch_size = luigi.IntParameter(
+        default=length_scales.cumulant.vertical_profile.calc.Z_BATCH_SIZE,
+        significant=False
+    )
+    single_precision = luigi.BoolParameter(default=False)
+    vectorised_widths = luigi.BoolParameter(default=False)
 
     def requires(self):
         reqs = {}
         reqs['fields'] = [
-                ExtractField3D(base_name=self.base_name,
-                                    field_name=self.v1),
-                ExtractField3D(base_name=self.base_name,
-                                    field_name=self.v2),
+                ExtractLevelChunkedField3D(base_name=self.base_name,
+                                           field_name=self.v1),
+                ExtractLevelChunkedField3D(base_name=self.base_name,
+                                           field_name=self.v2),
         ]
 
         if self.mask is not None:
@@ -953,9 +1308,17 @@ class ExtractCumulantScaleProfile(luigi.Task):
         with ipdb.launch_ipdb_on_exception():
             da = calc_fn(
                 v1_3d=da_v1, v2_3d=da_v2, width_method=self.width_method,
-                z_max=self.z_max, mask=mask
+                z_max=self.z_max, mask=mask, n_workers=self.n_workers,
+                z_batch_size=self.z_batch_size,
+                single_precision=self.single_precision,
+                vectorised_widths=self.vectorised_widths
             )
 
+        if self.single_precision:
+            da.attrs['precision'] = 'single'
+        if self.vectorised_widths:
+            da.attrs['width_estimation'] = 'vectorised'
+
         da.to_netcdf(self.output().path)
 
     def output(self):
@@ -963,6 +1326,194 @@ class ExtractCumulantScaleProfile(luigi.Task):
             base_name=self.base_name, v1=self.v1, v2=self.v2,
             mask=self.mask or "no_mask"
         )
+        if self.single_precision:
+            fn = fn.replace('.nc', '.single_precision.nc')
+        if self.vectorised_widths:
+            fn = fn.replace('.nc', '.vectorised_widths.nc')
+        p = WORKDIR/self.base_name/fn
+        return XArrayTarget(str(p))
+
+
+class ExtractCumulantScaleProfileSet(luigi.Task):
+    base_name = luigi.Parameter()
+    cumulants = luigi.Parameter()
+    z_max = luigi.FloatParameter(default=700.)
+    mask = luigi.Parameter(default=None)
+    mask_args = luigi.Parameter(default='')
+    width_method = length_scales.cumulant.calc.WidthEstimationMethod.MASS_WEIGHTED
+    n_workers = luigi.IntParameter(default=1, significant=False)
+    z_batch_size = luigi.IntParameter(
+        default=length_scales.cumulant.vertical_profile.calc.Z_BATCH_SIZE,
+        significant=False
+    )
+    single_precision = luigi.BoolParameter(default=False)
+    vectorised_widths = luigi.BoolParameter(default=False)
+
+    def _parse_cumulant_arg(self):
+        cums = [tuple(c.split(':')) for c in self.cumulants.split(',')]
+        return [c for (n,c) in enumerate(cums) if cums.index(c) == n]
+
+    def _get_field_names(self):
+        field_names = []
+        for c in self._parse_cumulant_arg():
+            for v in c:
+                if not v in field_names:
+                    field_names.append(v)
+        return field_names
+
+    def requires(self):
+        reqs = {}
+        reqs['fields'] = dict([
+            (v, ExtractLevelChunkedField3D(base_name=self.base_name,
+                                           field_name=v))
+            for v in self._get_field_names()
+        ])
+
+        if self.mask is not None:
+            reqs['mask'] = MakeMask(method_name=self.mask,
+                                    method_extra_args=self.mask_args,
+                                    base_name=self.base_name
+                                    )
+
+        return reqs
+
+    def run(self):
+        fields = dict([
+            (v, input.open(decode_times=False))
+            for (v, input) in self.input()['fields'].items()
+        ])
+
+        calc_fn = length_scales.cumulant.vertical_profile.calc.get_height_variation_of_characteristic_scales_for_cumulants
+
+        mask = None
+        if self.mask:
+            mask = self.input()['mask'].open(decode_times=False)
+
+        ds = calc_fn(
+            fields=fields, cumulants=self._parse_cumulant_arg(),
+            width_method=self.width_method, z_max=self.z_max, mask=mask,
+            n_workers=self.n_workers, z_batch_size=self.z_batch_size,
+            single_precision=self.single_precision,
+            vectorised_widths=self.vectorised_widths
+        )
+
+        if self.single_precision:
+            ds.attrs['precision'] = 'single'
+        if self.vectorised_widths:
+            ds.attrs['width_estimation'] = 'vectorised'
+
+        ds.to_netcdf(self.output().path)
+
+    def output(self):
+        unique_identifier = hashlib.md5(self.cumulants.encode('utf-8')).hexdigest()
+        fn = length_scales.cumulant.vertical_profile.calc.FN_FORMAT_SET.format(
+            base_name=self.base_name, identifier=unique_identifier,
+            mask=self.mask or "no_mask"
+        )
+        if self.single_precision:
+            fn = fn.replace('.nc', '.single_precision.nc')
+        if self.vectorised_widths:
+            fn = fn.replace('.nc', '.vectorised_widths.nc')
+        p = WORKDIR/self.base_name/fn
+        return XArrayTarget(str(p))
+
+
+class ExtractCumulantScaleProfileTimeMean(luigi.Task):
+    base_name = luigi.Parameter()
+    cumulants = luigi.Parameter()
+    tn_start = luigi.IntParameter()
+    tn_end = luigi.IntParameter()
+    z_max = luigi.FloatParameter(default=700.)
+    mask = luigi.Parameter(default=None)
+    mask_args = luigi.Parameter(default='')
+    width_method = length_scales.cumulant.calc.WidthEstimationMethod.MASS_WEIGHTED
+    z_batch_size = luigi.IntParameter(
+        default=length_scales.cumulant.vertical_profile.calc.Z_BATCH_SIZE,
+        significant=False
+    )
+    vectorised_widths = luigi.BoolParameter(default=False)
+
+    def _parse_cumulant_arg(self):
+        cums = [tuple(c.split(':')) for c in self.cumulants.split(',')]
+        return [c for (n,c) in enumerate(cums) if cums.index(c) == n]
+
+    def _get_field_names(self):
+        field_names = []
+        for c in self._parse_cumulant_arg():
+            for v in c:
+                if not v in field_names:
+                    field_names.append(v)
+        return field_names
+
+    def _get_timestep_base_names(self):
+        return [
+            "{}.tn{}".format(self.base_name, tn)
+            for tn in range(self.tn_start, self.tn_end+1)
+        ]
+
+    def requires(self):
+        reqs = []
+        for base_name in self._get_timestep_base_names():
+            reqs_timestep = {}
+            reqs_timestep['fields'] = dict([
+                (v, ExtractLevelChunkedField3D(base_name=base_name,
+                                               field_name=v))
+                for v in self._get_field_names()
+            ])
+
+            if self.mask is not None:
+                reqs_timestep['mask'] = MakeMask(
+                    method_name=self.mask, method_extra_args=self.mask_args,
+                    base_name=base_name
+                )
+            reqs.append(reqs_timestep)
+
+        return reqs
+
+    def _iterate_timesteps(self):
+        # open the fields one timestep at a time so that only the fields for
+        # the current timestep are loaded
+        for input in self.input():
+            fields = dict([
+                (v, input_field.open(decode_times=False))
+                for (v, input_field) in input['fields'].items()
+            ])
+
+            mask = None
+            if self.mask:
+                mask = input['mask'].open(decode_times=False)
+
+            yield fields, mask
+
+    def run(self):
+        calc_fn = length_scales.cumulant.vertical_profile.calc.get_time_mean_characteristic_scales_for_cumulants
+
+        ds = calc_fn(
+            timesteps=self._iterate_timesteps(),
+            cumulants=self._parse_cumulant_arg(),
+            width_method=self.width_method, z_max=self.z_max,
+            z_batch_size=self.z_batch_size,
+            vectorised_widths=self.vectorised_widths,
+        )
+
+        # the time-mean cumulants are as large as the 3D fields so we only
+        # keep the scales
+        ds = ds.drop('cumulant_mean')
+
+        if self.vectorised_widths:
+            ds.attrs['width_estimation'] = 'vectorised'
+
+        ds.to_netcdf(self.output().path)
+
+    def output(self):
+        unique_identifier = hashlib.md5(self.cumulants.encode('utf-8')).hexdigest()
+        fn = length_scales.cumulant.vertical_profile.calc.FN_FORMAT_TIME_MEAN.format(
+            base_name=self.base_name, identifier=unique_identifier,
+            mask=self.mask or "no_mask", tn_start=self.tn_start,
+            tn_end=self.tn_end
+        )
+        if self.vectorised_widths:
+            fn = fn.replace('.nc', '.vectorised_widths.nc')
         p = WORKDIR/self.base_name/fn
         return XArrayTarget(str(p))
 
@@ -973,6 +1524,8 @@ class ExtractCumulantScaleProfiles(luigi.Task):
 
     mask = luigi.Parameter(default=None)
     mask_args = luigi.Parameter(default='')
+    shared_spectra = luigi.BoolParameter(default=False)
+    vectorised_widths = luigi.BoolParameter(default=False)
 
     def _parse_cumulant_arg(self):
         cums = [c.split(':') for c in self.cumulants.split(',')]
@@ -982,10 +1535,19 @@ class ExtractCumulantScaleProfiles(luigi.Task):
         reqs = {}
 
         for base_name in self.base_names.split(','):
+            if self.shared_spectra:
+                reqs[base_name] = ExtractCumulantScaleProfileSet(
+                    base_name=base_name, cumulants=self.cumulants,
+                    mask=self.mask, mask_args=self.mask_args,
+                    vectorised_widths=self.vectorised_widths,
+                )
+                continue
+
             reqs[base_name] = [
                 ExtractCumulantScaleProfile(
                     base_name=base_name, v1=c[0], v2=c[1],
                     mask=self.mask, mask_args=self.mask_args,
+                    vectorised_widths=self.vectorised_widths,
                 )
                 for c in self._parse_cumulant_arg()
             ]
@@ -995,10 +1557,13 @@ class ExtractCumulantScaleProfiles(luigi.Task):
     def run(self):
         datasets = []
         for base_name in self.base_names.split(','):
-            ds_ = xr.concat([
-                input.open(decode_times=False)
-                for input in self.input()[base_name]
-            ], dim='cumulant')
+            if self.shared_spectra:
+                ds_ = self.input()[base_name].open(decode_times=False)
+            else:
+                ds_ = xr.concat([
+                    input.open(decode_times=False)
+                    for input in self.input()[base_name]
+                ], dim='cumulant')
             ds_['dataset_name'] = base_name
             datasets.append(ds_)
 
@@ -1009,6 +1574,8 @@ class ExtractCumulantScaleProfiles(luigi.Task):
         unique_props = (self.base_names + self.cumulants)
         unique_identifier = hashlib.md5(unique_props.encode('utf-8')).hexdigest()
         fn = "cumulant_profile.{}.nc".format(unique_identifier)
+        if self.vectorised_widths:
+            fn = fn.replace('.nc', '.vectorised_widths.nc')
         p = WORKDIR/fn
         return XArrayTarget(str(p))
 
@@ -1255,38 +1822,16 @@ class ComputePerObjectProfiles(luigi.Task):
         da = input['field'].open().squeeze()
         da_objects = input['objects'].open()
 
-        object_ids = np.unique(da_objects.chunk(None).values)
-        if object_ids[0] == 0:
-            object_ids = object_ids[1:]
-
-        kwargs = dict(scalar=da.name, objects=da_objects.name,
-                      object_ids=object_ids, op=self.op)
-
-        ds = xr.merge([da, da_objects])
+        ds = objects.integrate.integrate_profiles(
+            objects=da_objects, da=da, operators=[self.op], dim='zt'
+        )
+        da_by_height = ds["{}__{}".format(da.name, self.op)]
 
         if self.z_max is not None:
-            ds = ds.sel(zt=slice(None, self.z_max))
-
-        da_by_height = ds.groupby('zt').apply(self._apply_on_slice, kwargs=kwargs)
+            da_by_height = da_by_height.sel(zt=slice(None, self.z_max))
 
         da_by_height.to_netcdf(self.output().fn)
 
-    @staticmethod
-    def _apply_on_slice(ds, kwargs):
-        da_ = ds[kwargs['scalar']].compute()
-        da_objects_ = ds[kwargs['objects']].compute()
-        object_ids = kwargs['object_ids']
-        fn = getattr(dask_image.ndmeasure, kwargs['op'])
-        v = fn(da_, labels=da_objects_, index=object_ids).compute()
-        da = xr.DataArray(data=v, dims=['object_id',],
-                            coords=dict(object_id=object_ids))
-        da.name = "{}__{}".format(da_.name, kwargs['op'])
-        da.attrs['units'] = da_.units
-        da.attrs['long_name'] = '{} of {} per object'.format(
-            kwargs['op'], da_.long_name,
-        )
-        return da
-
     def output(self):
         mask_name = MakeMask.make_mask_name(
             base_name=self.base_name,
@@ -32,6 +32,7 @@ class CumulantScalesProfile(luigi.Task):
 
     mask = luigi.Parameter(default=None)
     mask_args = luigi.Parameter(default='')
+    shared_spectra = luigi.BoolParameter(default=False)
 
     def _parse_cumulant_arg(self):
         cums = [c.split(':') for c in self.cumulants.split(',')]
@@ -43,6 +44,7 @@ class CumulantScalesProfile(luigi.Task):
             cumulants=self.cumulants,
             mask=self.mask,
             mask_args=self.mask_args,
+            shared_spectra=self.shared_spectra,
         )
 
     def run(self):
@@ -85,8 +87,10 @@ class JointDistProfile(luigi.Task):
     def requires(self):
         reqs = dict(
             full_domain=[
-                data.ExtractField3D(field_name=self.v1, base_name=self.base_name),
-                data.ExtractField3D(field_name=self.v2, base_name=self.base_name),
+                data.ExtractLevelChunkedField3D(field_name=self.v1,
+                                                base_name=self.base_name),
+                data.ExtractLevelChunkedField3D(field_name=self.v2,
+                                                base_name=self.base_name),
             ],
         )
 
@@ -328,10 +332,10 @@ class CumulantSlices(luigi.Task):
 
         return dict(
             (base_name, {
-                self.v1 : data.ExtractField3D(field_name=self.v1,
-                                              base_name=base_name),
-                self.v2 : data.ExtractField3D(field_name=self.v2,
-                                              base_name=base_name),
+                self.v1 : data.ExtractLevelChunkedField3D(field_name=self.v1,
+                                                          base_name=base_name),
+                self.v2 : data.ExtractLevelChunkedField3D(field_name=self.v2,
+                                                          base_name=base_name),
             })
             for base_name in base_names
         )
@@ -461,8 +465,9 @@ class CrossSection(luigi.Task):
 
     def requires(self):
         return dict([
-            (base_name, data.ExtractField3D(base_name=base_name,
-                                            field_name=self.var_name))
+            (base_name, data.ExtractLevelChunkedField3D(
+                base_name=base_name, field_name=self.var_name
+            ))
             for base_name in self.base_names.split(',')
         ])
 
@@ -1244,6 +1249,7 @@ class Suite(luigi.Task):
                     base_names=base_names,
                     cumulants="w:w,qv:qv,qc:qc,theta_l:theta_l,cvrxp:cvrxp,w:qv,w:qc,w:cvrxp",
                     z_max=1000.,
+                    shared_spectra=True,
                 )
         else:
             reqs['mean_profile'] = HorizontalMeanProfile(